@@ -0,0 +1,54 @@
+import hashlib
+import json
+import os
+import random
+from datetime import timedelta
+from sqlalchemy.orm import Session
+from models import AdviceCache, jst_now
+
+# キーごとに保持するアドバイスのバリエーション数
+ADVICE_CACHE_VARIANTS = int(os.getenv('ADVICE_CACHE_VARIANTS', '3'))
+
+# キャッシュの有効期間（日）
+ADVICE_CACHE_MAX_AGE_DAYS = float(os.getenv('ADVICE_CACHE_MAX_AGE_DAYS', '30'))
+
+# プロンプトとモデル名からキャッシュキーを作成する関数
+def make_cache_key(messages, model: str):
+    payload = json.dumps({"model": model, "messages": messages}, ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+# 有効期限の境界となる日時を返す関数（DBにはタイムゾーンなしの日本時間で保存されている）
+def _expiry_cutoff():
+    return jst_now().replace(tzinfo=None) - timedelta(days=ADVICE_CACHE_MAX_AGE_DAYS)
+
+# キャッシュからアドバイスを取得する関数。バリエーションが揃っていない場合はNoneを返す
+def get_cached_advice(db: Session, cache_key: str):
+    variants = db.query(AdviceCache.advice_text).filter(
+        AdviceCache.cache_key == cache_key,
+        AdviceCache.create_datetime >= _expiry_cutoff()
+    ).all()
+    if len(variants) < ADVICE_CACHE_VARIANTS:
+        return None
+    return random.choice(variants).advice_text
+
+# 生成したアドバイスをキャッシュに保存する関数。上限を超えた古いバリエーションは削除する
+def store_advice(db: Session, cache_key: str, model: str, advice_text: str):
+    db.add(AdviceCache(cache_key=cache_key, model=model, advice_text=advice_text))
+    db.flush()
+
+    stale_ids = [
+        row.advice_cache_id for row in db.query(AdviceCache.advice_cache_id).filter(
+            AdviceCache.cache_key == cache_key
+        ).order_by(AdviceCache.create_datetime.desc(), AdviceCache.advice_cache_id.desc()).offset(ADVICE_CACHE_VARIANTS)
+    ]
+    if stale_ids:
+        db.query(AdviceCache).filter(AdviceCache.advice_cache_id.in_(stale_ids)).delete(synchronize_session=False)
+    db.commit()
+
+# 有効期限切れのキャッシュを削除する関数
+def prune_advice_cache(db: Session):
+    deleted = db.query(AdviceCache).filter(
+        AdviceCache.create_datetime < _expiry_cutoff()
+    ).delete(synchronize_session=False)
+    db.commit()
+    return deleted
@@ -0,0 +1,165 @@
+import argparse
+import asyncio
+import json
+import os
+import resource
+import sys
+import time
+import tracemalloc
+from datetime import datetime
+import httpx
+from load_test import BASE_DIR, free_port, start_server
+
+# daily_message_create.pyのバッチを合成ユーザーで実行するベンチマーク
+# OuraAPIとOpenAI APIはupstream_stubで代替し、実行時間・外部API呼び出し回数・
+# DBの往復回数・最大メモリ使用量をJSONに出力する
+# コネクションプールは--concurrencyに合わせて作成する（DB_POOL_SIZE・DB_MAX_OVERFLOWを指定した場合はその値を使う）
+# 実行例: python batch_benchmark.py --users 10000 --concurrency 50 --openai-latency-ms 2000
+
+# 合成ユーザーを一括で投入する関数
+def seed_users(users: int, batch_size: int = 5000):
+    from sqlalchemy import insert
+    from db.db_config import Base, engine, SessionLocal
+    from models import User
+    from password_hashing import hash_password
+    from insert_coping_master_data import load_csv_to_db
+
+    Base.metadata.drop_all(bind=engine)
+    Base.metadata.create_all(bind=engine)
+
+    # バッチはパスワードを使わないため、全ユーザーで同じハッシュを使う
+    password_hash = hash_password("batch-benchmark-password")
+    db = SessionLocal()
+    try:
+        for offset in range(0, users, batch_size):
+            rows = [
+                {
+                    "user_name": f"batch_user_{i}",
+                    "email": f"batch_user_{i}@example.com",
+                    "password": password_hash,
+                    "oura_id": 1 + i % 2,
+                    "type_id": 1,
+                    "occupation_id": "1",
+                    "overtime_id": 20
+                }
+                for i in range(offset, min(users, offset + batch_size))
+            ]
+            db.execute(insert(User), rows)
+        db.commit()
+
+        # コーピングマスタはリポジトリのCSVを使う
+        load_csv_to_db(os.path.join(BASE_DIR, 'coping_master.csv'), db)
+    finally:
+        db.close()
+
+# DBへのSQL実行回数とコミット回数を数える関数
+def count_db_round_trips(engine):
+    from sqlalchemy import event
+    counts = {"statements": 0, "commits": 0}
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def on_execute(conn, cursor, statement, parameters, context, executemany):
+        counts["statements"] += 1
+
+    @event.listens_for(engine, "commit")
+    def on_commit(conn):
+        counts["commits"] += 1
+
+    return counts
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="daily_message_create.pyのバッチのベンチマーク")
+    parser.add_argument("--db-url", default=f"sqlite:///{os.path.join(BASE_DIR, 'batch_benchmark.db')}", help="バッチが使うDBのURL（テーブルは作り直される）")
+    parser.add_argument("--users", type=int, default=1000, help="合成ユーザー数")
+    parser.add_argument("--concurrency", type=int, default=20, help="同時に処理するユーザー数")
+    parser.add_argument("--chunk-size", type=int, default=200, help="1トランザクションで保存するユーザー数")
+    parser.add_argument("--oura-latency-ms", type=float, default=300, help="OuraAPIスタブの応答遅延")
+    parser.add_argument("--openai-latency-ms", type=float, default=1500, help="OpenAI APIスタブの応答遅延")
+    parser.add_argument("--openai-error-rate", type=float, default=0.0, help="OpenAI APIスタブが429を返す割合")
+    parser.add_argument("--tracemalloc", action="store_true", help="Pythonのヒープの最大使用量も計測する（実行は遅くなる）")
+    parser.add_argument("--output", default=os.path.join(BASE_DIR, 'batch_benchmark_result.json'), help="結果を出力するJSONファイル")
+    args = parser.parse_args(argv)
+
+    stub_port = free_port()
+    stub_env = {
+        **os.environ,
+        "STUB_LATENCY_MS": str(args.oura_latency_ms),
+        "STUB_OPENAI_LATENCY_MS": str(args.openai_latency_ms),
+        "STUB_OPENAI_ERROR_RATE": str(args.openai_error_rate),
+    }
+
+    # プールが同時実行数より小さいとコネクション待ちのタイムアウトを計測してしまうため、
+    # エンジンの作成前に同時実行数分（と一括保存用の1本）のプールを確保する
+    os.environ.setdefault("DB_POOL_SIZE", str(args.concurrency + 1))
+    os.environ.setdefault("DB_MAX_OVERFLOW", "5")
+
+    # バッチのモジュールを読み込む前に、接続先をローカルのDBとスタブに差し替える
+    os.environ.update({
+        "DATABASE_URL": args.db_url,
+        "OURA_API_BASE_URL": f"http://127.0.0.1:{stub_port}",
+        "OPENAI_BASE_URL": f"http://127.0.0.1:{stub_port}/v1",
+        "OURA_API_KEY_1": "batch-benchmark-key-1",
+        "OURA_API_KEY_2": "batch-benchmark-key-2",
+        "GPT_API_KEY": "batch-benchmark-key",
+    })
+
+    print(f"Seeding {args.users} users into {args.db_url}")
+    seed_start = time.perf_counter()
+    seed_users(args.users)
+    print(f"Seeded in {time.perf_counter() - seed_start:.1f}s")
+
+    import daily_message_create
+    import metrics
+    from db.db_config import engine
+    db_counts = count_db_round_trips(engine)
+
+    stub = start_server('upstream_stub:app', stub_port, stub_env, '/_stats')
+    try:
+        if args.tracemalloc:
+            tracemalloc.start()
+        start = time.perf_counter()
+        results = asyncio.run(daily_message_create.run(args.concurrency, args.chunk_size))
+        elapsed = time.perf_counter() - start
+        peak_traced = None
+        if args.tracemalloc:
+            _, peak_traced = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+        upstream_calls = httpx.get(f"http://127.0.0.1:{stub_port}/_stats").json()
+    finally:
+        stub.terminate()
+        stub.wait()
+
+    # ru_maxrssはLinuxではKB、macOSではバイト単位
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    max_rss_mb = max_rss / (1024 * 1024) if sys.platform == 'darwin' else max_rss / 1024
+
+    report = {
+        "timestamp": datetime.now().isoformat(timespec='seconds'),
+        "config": {
+            "users": args.users,
+            "concurrency": args.concurrency,
+            "db_pool_size": int(os.environ["DB_POOL_SIZE"]),
+            "db_max_overflow": int(os.environ["DB_MAX_OVERFLOW"]),
+            "chunk_size": args.chunk_size,
+            "oura_latency_ms": args.oura_latency_ms,
+            "openai_latency_ms": args.openai_latency_ms,
+            "openai_error_rate": args.openai_error_rate,
+        },
+        "wall_clock_seconds": elapsed,
+        "users_per_second": args.users / elapsed if elapsed else 0.0,
+        "results": {status: results.count(status) for status in set(results)},
+        "upstream_calls": upstream_calls,
+        "db_round_trips": db_counts,
+        "batch_metrics": metrics.snapshot(),
+        "peak_memory_mb": {
+            "python_heap": peak_traced / (1024 * 1024) if peak_traced is not None else None,
+            "max_rss": max_rss_mb
+        }
+    }
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"Results written to {args.output}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+import os
+from sqlalchemy import insert, select, update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+from models import ConditionSnapshot, jst_now
+
+# スナップショットに保存するcontributorsの項目
+CONTRIBUTOR_NAMES = [
+    'activity_balance', 'body_temperature', 'hrv_balance', 'previous_day_activity',
+    'previous_night', 'recovery_index', 'resting_heart_rate', 'sleep_balance'
+]
+
+# スナップショットを古いとみなすまでの時間（秒）
+CONDITION_SNAPSHOT_MAX_AGE = float(os.getenv('CONDITION_SNAPSHOT_MAX_AGE', '3600'))
+
+# Ouraのdaily_readinessの1日分のデータから、スナップショットの行データを作成する関数
+def snapshot_row(oura_id: int, entry: dict):
+    contributors = entry.get('contributors') or {}
+    return {
+        "oura_id": oura_id,
+        "day": entry['day'],
+        "score": entry.get('score'),
+        **{name: contributors.get(name) for name in CONTRIBUTOR_NAMES}
+    }
+
+# スナップショットをdaily_readinessと同じ形式の辞書に戻す関数
+def snapshot_entry(snapshot):
+    return {
+        "day": snapshot.day,
+        "score": snapshot.score,
+        "contributors": {name: getattr(snapshot, name) for name in CONTRIBUTOR_NAMES}
+    }
+
+# スナップショットを保存する関数（同じoura_id・日付の行があれば更新し、なければ追加する）
+def save_snapshots(db: Session, rows):
+    rows = {(row['oura_id'], row['day']): row for row in rows}
+    if not rows:
+        return 0
+
+    for attempt in range(2):
+        try:
+            existing = db.execute(select(
+                ConditionSnapshot.condition_snapshot_id, ConditionSnapshot.oura_id, ConditionSnapshot.day
+            ).filter(
+                ConditionSnapshot.oura_id.in_({key[0] for key in rows}),
+                ConditionSnapshot.day.in_({key[1] for key in rows})
+            ))
+            ids = {(row.oura_id, row.day): row.condition_snapshot_id for row in existing}
+
+            now = jst_now()
+            updates = [{**row, "condition_snapshot_id": ids[key], "update_datetime": now} for key, row in rows.items() if key in ids]
+            inserts = [{**row, "create_datetime": now, "update_datetime": now} for key, row in rows.items() if key not in ids]
+            if updates:
+                db.execute(update(ConditionSnapshot), updates)
+            if inserts:
+                db.execute(insert(ConditionSnapshot), inserts)
+            db.commit()
+            return len(rows)
+        except IntegrityError:
+            # 別のプロセスが同じ行を先に追加した場合は、更新としてやり直す
+            db.rollback()
+            if attempt:
+                raise
+
+# スナップショットが存在しない、または古いか判定する関数（DBにはタイムゾーンなしの日本時間で保存されている）
+def is_stale(snapshot, max_age: float = CONDITION_SNAPSHOT_MAX_AGE):
+    if snapshot is None or snapshot.update_datetime is None:
+        return True
+    now = jst_now()
+    if snapshot.update_datetime.tzinfo is None:
+        now = now.replace(tzinfo=None)
+    return (now - snapshot.update_datetime).total_seconds() > max_age
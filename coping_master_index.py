@@ -0,0 +1,79 @@
+from dataclasses import dataclass
+from threading import Lock
+from sqlalchemy import func
+from sqlalchemy.orm import Session
+from models import CopingMaster
+
+# コーピングマスタ1行分のスナップショット（セッションに依存しない読み取り専用データ）
+@dataclass(frozen=True)
+class CopingMasterRecord:
+    coping_master_id: int
+    type_no: int
+    type_name: str
+    score_id: int
+    time: int
+    tone: str
+    rest_type: str
+    how_to_rest: str
+
+# 件数・最大ID・最終更新日時からバージョン文字列を作る関数
+def _make_version(count, max_id, max_update_datetime):
+    return f"{count}:{max_id}:{max_update_datetime}"
+
+# DB上のコーピングマスタの現在のバージョンを取得する関数（集計クエリ1回）
+def fetch_master_version(db: Session):
+    count, max_id, max_update_datetime = db.query(
+        func.count(CopingMaster.coping_master_id),
+        func.max(CopingMaster.coping_master_id),
+        func.max(CopingMaster.update_datetime)
+    ).one()
+    return _make_version(count, max_id, max_update_datetime)
+
+# コーピングマスタを(type_name, score_id, time)をキーにメモリ上に保持するクラス
+class CopingMasterIndex:
+    def __init__(self):
+        self.version = None
+        self._index = {}
+        self._lock = Lock()
+
+    # コーピングマスタを全件読み込んでインデックスを作り直す関数
+    def load(self, db: Session):
+        rows = db.query(CopingMaster).all()
+        index = {}
+        for row in rows:
+            record = CopingMasterRecord(
+                coping_master_id=row.coping_master_id,
+                type_no=row.type_no,
+                type_name=row.type_name,
+                score_id=row.score_id,
+                time=row.time,
+                tone=row.tone,
+                rest_type=row.rest_type,
+                how_to_rest=row.how_to_rest
+            )
+            index.setdefault((row.type_name, row.score_id, row.time), []).append(record)
+
+        # 読み込んだ行そのものからバージョンを計算し、データとバージョンを一致させる
+        version = _make_version(
+            len(rows),
+            max((row.coping_master_id for row in rows), default=None),
+            max((row.update_datetime for row in rows if row.update_datetime is not None), default=None)
+        )
+        with self._lock:
+            self._index = index
+            self.version = version
+        print(f"Loaded {len(rows)} coping master records (version {version})")
+
+    # DB上のバージョンが変わっていれば読み込み直す関数。読み込んだ場合はTrueを返す
+    def refresh_if_stale(self, db: Session):
+        if self.version is not None and fetch_master_version(db) == self.version:
+            return False
+        self.load(db)
+        return True
+
+    # 条件に一致するコーピングレコードの一覧を返す関数
+    def get(self, type_name: str, score_id: int, time: int):
+        return self._index.get((type_name, score_id, time), [])
+
+# プロセス内で共有するインデックス
+coping_master_index = CopingMasterIndex()
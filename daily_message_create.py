@@ -1,13 +1,23 @@
-import requests
-from datetime import datetime, timedelta
-from openai import OpenAI
+import argparse
+import asyncio
+import hashlib
+import json
+import time
+from datetime import datetime, timedelta, timezone
+from openai import AsyncOpenAI, APIConnectionError, InternalServerError, RateLimitError
 import os
-from models import CopingMaster, User, CopingMessage, DailyMessage
-from sqlalchemy import and_, func
-from sqlalchemy.orm import Session
-from db.db_config import SessionLocal
+from models import User, CopingMessage, DailyMessage, AdviceCache, ConditionSnapshot, HeartRateDay, BatchFingerprint, jst_now, day_range
+from sqlalchemy import delete, insert
+from db.db_config import SessionLocal, Base, engine, DB_POOL_SIZE, DB_MAX_OVERFLOW
 from dotenv import load_dotenv
 import random
+import oura_client
+from settings import get_settings
+import advice_cache
+import condition_snapshot
+import heart_rate_store
+from coping_master_index import coping_master_index
+import metrics
 
 # .envファイルから環境変数を読み込む
 load_dotenv()
@@ -17,6 +27,31 @@ OURA_API_KEY_1 = os.getenv('OURA_API_KEY_1')
 OURA_API_KEY_2 = os.getenv('OURA_API_KEY_2')
 GPT_API_KEY = os.getenv('GPT_API_KEY')
 
+# アドバイス生成に使うGPTのモデル
+GPT_MODEL = os.getenv('GPT_MODEL', 'gpt-4-turbo')
+
+# GPTへの同時リクエスト数・リトライ回数・タイムアウト（秒）
+GPT_CONCURRENCY = int(os.getenv('GPT_CONCURRENCY', '8'))
+GPT_MAX_RETRIES = int(os.getenv('GPT_MAX_RETRIES', '3'))
+GPT_RETRY_BASE_DELAY = float(os.getenv('GPT_RETRY_BASE_DELAY', '1'))
+GPT_TIMEOUT = float(os.getenv('GPT_TIMEOUT', '30'))
+
+# GPTの共有クライアントとセマフォ（最初の利用時に生成する）
+_gpt_client = None
+_gpt_semaphore = None
+
+# 同時に処理するユーザー数（DBのコネクションプールを超える値はclamp_concurrencyで切り詰める）
+BATCH_CONCURRENCY = int(os.getenv('BATCH_CONCURRENCY', '5'))
+
+# メッセージをまとめて保存する単位（ユーザー数）
+BATCH_WRITE_CHUNK_SIZE = int(os.getenv('BATCH_WRITE_CHUNK_SIZE', '50'))
+
+# 心拍数サンプルを遡って取り込む日数（前回の取り込み以降の差分のみ取得する。0の場合は取り込まない）
+HEART_RATE_BACKFILL_DAYS = float(os.getenv('HEART_RATE_BACKFILL_DAYS', '1'))
+
+# 実行サマリー（メトリクス）のJSONの出力先（未設定の場合は標準出力のみ）
+BATCH_METRICS_OUTPUT = os.getenv('BATCH_METRICS_OUTPUT')
+
 # 日付に関する定義
 yesterday_date = (datetime.today() - timedelta(days=1)).strftime('%Y-%m-%d')
 today_date = datetime.today().strftime('%Y-%m-%d')
@@ -29,47 +64,69 @@ if current_day in [0, 1, 2, 3, 4]:  # 平日
 else:  # 休日
     time_values = (60, 180, 200)
 
-# SQLAlchemyのDB接続
-def get_db():
-    db = SessionLocal()
-    try:
-        yield db
-    finally:
-        db.close()
-
-# 指定したコーピングをコーピングマスタから取得する関数
-def fetch_coping_master(db: Session, score_id: int, time_value: int):
-    return db.query(CopingMaster).filter(
-        CopingMaster.type_name == '焦燥',
-        CopingMaster.score_id == score_id,
-        CopingMaster.time == time_value
-    ).all()
-
-# OuraAPIから昨日と今日のスコアを取得する関数
-def fetch_daily_readiness(api_key: str):
-    url = 'https://api.ouraring.com/v2/usercollection/daily_readiness'
-    params = {
-        'start_date': yesterday_date,
-        'end_date': today_date
-    }
-    headers = {
-        'Authorization': f'Bearer {api_key}'
-    }
+# 指定したコーピングをコーピングマスタ（メモリ上のインデックス）から取得する関数
+def fetch_coping_master(score_id: int, time_value: int):
+    return coping_master_index.get('焦燥', score_id, time_value)
 
-    response = requests.get(url, headers=headers, params=params)
-    if response.status_code != 200:
-        print(f"Failed to fetch data from API, status code: {response.status_code}")
-        return 0, 0
+# OuraAPIから昨日と今日のdaily_readinessを取得する関数。取得できなかった場合は空のリストを返す
+async def fetch_daily_readiness(api_key: str):
+    data = await oura_client.fetch_daily_readiness(api_key, yesterday_date, today_date)
+    if data is None:
+        return []
 
-    data = response.json()
     if not data['data']:
         print("No data found for today")
-        return 0, 0
+        return []
+    return data['data']
 
-    # データからスコアを抽出
-    scores = {entry['day']: entry['score'] for entry in data['data']}
+# daily_readinessのデータから昨日と今日のスコアを抽出する関数
+def extract_scores(entries):
+    scores = {entry['day']: entry['score'] for entry in entries}
     return scores.get(yesterday_date, 0), scores.get(today_date, 0)
 
+# Webhookで保存済みのスナップショットから、昨日と今日のdaily_readinessを読み込む関数
+# （今日のスナップショットがあるAPIキーのみを返す）
+def load_snapshot_readiness(groups):
+    oura_ids = {api_key: {user.oura_id for user in group} for api_key, group in groups.items()}
+    db = SessionLocal()
+    try:
+        snapshots = db.query(ConditionSnapshot).filter(
+            ConditionSnapshot.oura_id.in_({oura_id for ids in oura_ids.values() for oura_id in ids}),
+            ConditionSnapshot.day.in_([yesterday_date, today_date])
+        ).all()
+    finally:
+        db.close()
+
+    entries_by_oura_id = {}
+    for snapshot in snapshots:
+        entries_by_oura_id.setdefault(snapshot.oura_id, []).append(condition_snapshot.snapshot_entry(snapshot))
+
+    readiness_by_key = {}
+    for api_key, ids in oura_ids.items():
+        for oura_id in ids:
+            entries = entries_by_oura_id.get(oura_id, [])
+            if any(entry['day'] == today_date for entry in entries):
+                readiness_by_key[api_key] = entries
+                break
+    return readiness_by_key
+
+# 取得したdaily_readinessをコンディションのスナップショットとして保存する関数（/conditionが参照する）
+def save_condition_snapshots(groups, readiness_by_key):
+    rows = [
+        condition_snapshot.snapshot_row(oura_id, entry)
+        for api_key, group in groups.items()
+        for oura_id in {user.oura_id for user in group}
+        for entry in readiness_by_key[api_key]
+    ]
+    db = SessionLocal()
+    try:
+        return condition_snapshot.save_snapshots(db, rows)
+    except Exception as e:
+        print(f"Error saving condition snapshots: {e!r}")
+        return 0
+    finally:
+        db.close()
+
 
 # ユーザーによってOuraAPIキーを変える関数
 def select_api_key(user):
@@ -124,58 +181,124 @@ def get_assistant_content(score_id):
     return random.choice(messages)
 
 # 取得したtime_valueの数だけcoping_masterからコーピングレコードを取得する関数
-def fetch_all_coping_lists(db: Session, score_id: int, time_values):
+def fetch_all_coping_lists(score_id: int, time_values):
     coping_lists = []
     for time_value in time_values:
-        result = fetch_coping_master(db, score_id, time_value)
+        result = fetch_coping_master(score_id, time_value)
         if result:
             random_record = random.choice(result)  # ランダムに1行を選択
             coping_lists.append(random_record)
     return coping_lists
 
-# GPTを利用する関数
-def generate_gpt_response(coping_lists):
-    advice_lists = []
-    client = OpenAI(api_key=GPT_API_KEY)
-    for index, record in enumerate(coping_lists):
+# GPTに送るプロンプトを作成する関数
+def build_gpt_messages(record):
+    return [
+        {"role": "system", "content": "あなたは残業が異常に多いビジネスマンに休憩の方法をアドバイスする、経験豊富なアドバイザーです。彼らは責任感が強く、休むことに対して罪悪感を感じる傾向があります。"},
+        {"role": "user", "content": "以下の休憩方法を50字以内で紹介してください。"},
+        {"role": "user", "content": f"{record.rest_type}"}
+    ]
+
+# GPTの共有クライアントを取得する関数（リトライは自前で行うためクライアント側では無効化）
+def get_gpt_client():
+    global _gpt_client
+    if _gpt_client is None:
+        _gpt_client = AsyncOpenAI(api_key=GPT_API_KEY, max_retries=0, timeout=GPT_TIMEOUT)
+    return _gpt_client
+
+# GPTの同時リクエスト数を制限するセマフォを取得する関数
+def get_gpt_semaphore():
+    global _gpt_semaphore
+    if _gpt_semaphore is None:
+        _gpt_semaphore = asyncio.Semaphore(max(1, GPT_CONCURRENCY))
+    return _gpt_semaphore
+
+# GPTの共有クライアントを閉じる関数
+async def close_gpt_client():
+    global _gpt_client, _gpt_semaphore
+    if _gpt_client is not None:
+        await _gpt_client.close()
+    _gpt_client = None
+    _gpt_semaphore = None
+
+# GPTにアドバイスを問い合わせる関数。429/5xx/接続エラーは指数バックオフでリトライする
+async def request_gpt_advice(messages):
+    for attempt in range(GPT_MAX_RETRIES + 1):
         try:
-            chat_completion = client.chat.completions.create(
-                messages=[
-                    {"role": "system", "content": "あなたは残業が異常に多いビジネスマンに休憩の方法をアドバイスする、経験豊富なアドバイザーです。彼らは責任感が強く、休むことに対して罪悪感を感じる傾向があります。"},
-                    {"role": "user", "content": "以下の休憩方法を50字以内で紹介してください。"},
-                    {"role": "user", "content": f"{record.rest_type}"}
-                ],
-                model="gpt-4-turbo",
-            )
-            advice = chat_completion.choices[0].message.content.strip()
-            advice_lists.append(advice)
-            print(f"Advice for coping item {index + 1}: {advice}")
+            async with get_gpt_semaphore():
+                # セマフォの待ち時間を含めないよう、取得後から計測する
+                start = time.perf_counter()
+                try:
+                    chat_completion = await get_gpt_client().chat.completions.create(
+                        messages=messages,
+                        model=GPT_MODEL,
+                    )
+                except Exception as e:
+                    status = getattr(e, 'status_code', None) or e.__class__.__name__
+                    metrics.upstream_request_duration.observe(
+                        time.perf_counter() - start, service='openai', endpoint='chat.completions', status=str(status))
+                    raise
+                metrics.upstream_request_duration.observe(
+                    time.perf_counter() - start, service='openai', endpoint='chat.completions', status='200')
+            return chat_completion.choices[0].message.content.strip()
+        except (RateLimitError, InternalServerError, APIConnectionError) as e:
+            if attempt == GPT_MAX_RETRIES:
+                raise
+            delay = GPT_RETRY_BASE_DELAY * (2 ** attempt) * random.uniform(1, 1.5)
+            print(f"GPT request failed ({e.__class__.__name__}), retrying in {delay:.1f}s")
+            await asyncio.sleep(delay)
+
+# アドバイスキャッシュを参照する関数（別スレッドで実行し、専用のセッションを参照後すぐに閉じる）
+def lookup_cached_advice(cache_keys):
+    db = SessionLocal()
+    try:
+        return [advice_cache.get_cached_advice(db, key) for key in cache_keys]
+    finally:
+        db.close()
+
+# GPTを利用する関数（キャッシュにないものだけを並行に問い合わせ、順序は入力のまま返す）
+# GPTの応答を待つ間はコネクションを保持しないよう、DBへのアクセスはそれぞれ専用のセッションで行う
+async def generate_gpt_response(coping_lists):
+    prompts = [build_gpt_messages(record) for record in coping_lists]
+    cache_keys = [advice_cache.make_cache_key(messages, GPT_MODEL) for messages in prompts]
+    cached = await asyncio.to_thread(lookup_cached_advice, cache_keys)
 
+    async def generate(index):
+        if cached[index] is not None:
+            return cached[index]
+        try:
+            return await request_gpt_advice(prompts[index])
         except Exception as e:
             print(f"Error processing coping item {index + 1}: {e}")
+            return None
 
-    return advice_lists
-
-# coping_messageを保存する関数
-def save_coping_message(db, user_id, assistant_text, message_text):
-    new_coping_message = CopingMessage(
-        user_id=user_id,
-        assistant_text=assistant_text,
-        coping_message_text=message_text,
-        satisfaction_score="とても良い",
-        heart_rate_before=0,
-        heart_rate_after=0
-    )
-    db.add(new_coping_message)
-    db.commit()
-
-# coping_messageを取り出す関数
-def get_coping_results(db, user_id, today_date):
-    return db.query(CopingMessage).filter(
-        CopingMessage.user_id == user_id,
-        func.date(CopingMessage.create_datetime) == today_date,
+    results = await asyncio.gather(*(generate(index) for index in range(len(prompts))))
+
+    # 新しく生成したアドバイスをキャッシュに保存
+    def store_generated():
+        db = SessionLocal()
+        try:
+            for index, advice in enumerate(results):
+                if advice is not None and cached[index] is None:
+                    try:
+                        advice_cache.store_advice(db, cache_keys[index], GPT_MODEL, advice)
+                    except Exception as e:
+                        db.rollback()
+                        print(f"Error caching coping item {index + 1}: {e}")
+        finally:
+            db.close()
+    await asyncio.to_thread(store_generated)
+
+    return [advice for advice in results if advice is not None]
+
+# 今日のcoping_message（満足度あり）が登録済みのユーザーIDを取得する関数
+def get_coping_result_user_ids(db, today_date):
+    start, end = day_range(today_date)
+    rows = db.query(CopingMessage.user_id).filter(
+        CopingMessage.create_datetime >= start,
+        CopingMessage.create_datetime < end,
         CopingMessage.satisfaction_score.isnot(None)
-    ).all()
+    ).distinct().all()
+    return {row.user_id for row in rows}
 
 # daily_messageを生成する関数
 def generate_daily_message_text(coping_results, todays_score, yesterdays_score):
@@ -213,85 +336,373 @@ def generate_daily_message_text(coping_results, todays_score, yesterdays_score):
         else:
             return f'昨日よりスコアが少し下がっています。{get_score_comment(todays_score)}'
 
-# daily_messageを保存する関数
-def save_daily_message(db, user_id, daily_message_text, yesterdays_score, todays_score):
-    new_daily_message = DailyMessage(
-        user_id=user_id,
-        daily_message_text=daily_message_text,
-        previous_days_score=yesterdays_score,
-        todays_days_score=todays_score
-    )
-    db.add(new_daily_message)
-    db.commit()
-
-def main():
-
-    # データベースセッションの作成
-    db_gen = get_db()
-    db = next(db_gen)
-
-    # すべてのユーザーを取得
-    users = db.query(User).all()
+# coping_messageとdaily_messageの保存用の行データを作成する関数
+def build_message_rows(user_id, assistant_text, advice_lists, daily_message_text, yesterdays_score, todays_score):
+    now = jst_now()
+    coping_rows = [
+        {
+            "user_id": user_id,
+            "assistant_text": assistant_text,
+            "coping_message_text": advice,
+            "satisfaction_score": "とても良い",
+            "heart_rate_before": 0,
+            "heart_rate_after": 0,
+            "create_datetime": now,
+            "update_datetime": now
+        }
+        for advice in advice_lists
+    ]
+    daily_row = {
+        "user_id": user_id,
+        "daily_message_text": daily_message_text,
+        "previous_days_score": yesterdays_score,
+        "todays_days_score": todays_score,
+        "create_datetime": now,
+        "update_datetime": now
+    }
+    return coping_rows, daily_row
+
+# メッセージ生成の入力からフィンガープリントを計算する関数
+# （日付・スコア・score_id・時間枠・コーピングマスタのバージョン・モデルが同じなら同じ値になる）
+def input_fingerprint(yesterdays_score, todays_score, score_id):
+    payload = json.dumps({
+        "day": today_date,
+        "yesterdays_score": yesterdays_score,
+        "todays_score": todays_score,
+        "score_id": score_id,
+        "time_values": list(time_values),
+        "coping_master_version": coping_master_index.version,
+        "model": GPT_MODEL
+    }, sort_keys=True)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+# 今日の実行で保存したフィンガープリントを取得する関数（キー: user_id）
+def load_fingerprints(db):
+    rows = db.query(BatchFingerprint.user_id, BatchFingerprint.fingerprint).filter(
+        BatchFingerprint.day == today_date
+    ).all()
+    return {row.user_id: row.fingerprint for row in rows}
+
+# 複数ユーザー分の行データをまとめてINSERTする関数（コミットは呼び出し側で行う）
+# フィンガープリントも同じトランザクションで置き換え、メッセージの保存に失敗したユーザーは次回作り直されるようにする
+def insert_message_rows(db, outputs):
+    coping_rows = [row for _, rows, _, _ in outputs for row in rows]
+    daily_rows = [daily_row for _, _, daily_row, _ in outputs]
+    now = jst_now()
+    fingerprint_rows = [
+        {"user_id": user.user_id, "day": today_date, "fingerprint": fingerprint, "create_datetime": now, "update_datetime": now}
+        for user, _, _, fingerprint in outputs
+        if fingerprint is not None
+    ]
+    if coping_rows:
+        db.execute(insert(CopingMessage), coping_rows)
+    if daily_rows:
+        db.execute(insert(DailyMessage), daily_rows)
+    if fingerprint_rows:
+        db.execute(delete(BatchFingerprint).where(
+            BatchFingerprint.user_id.in_([row["user_id"] for row in fingerprint_rows])
+        ))
+        db.execute(insert(BatchFingerprint), fingerprint_rows)
+
+# 生成したメッセージを溜めておき、chunk_size人分ごとに1トランザクションで保存するクラス
+class MessageWriter:
+    def __init__(self, chunk_size: int = BATCH_WRITE_CHUNK_SIZE):
+        self.chunk_size = max(1, chunk_size)
+        self.pending = []
+        self.failed_users = []
+        self.transactions = 0
+        self._lock = asyncio.Lock()
+
+    # 1ユーザー分の出力を追加する関数。chunk_size人分溜まったら保存する
+    async def add(self, user, coping_rows, daily_row, fingerprint=None):
+        self.pending.append((user, coping_rows, daily_row, fingerprint))
+        if len(self.pending) >= self.chunk_size:
+            await self.flush()
+
+    # 溜まっている出力をすべて保存する関数
+    async def flush(self):
+        async with self._lock:
+            outputs, self.pending = self.pending, []
+            if outputs:
+                await asyncio.to_thread(self._write, outputs)
+
+    def _write(self, outputs):
+        with metrics.batch_stage_duration.time(stage='write_messages'):
+            self._write_outputs(outputs)
+
+    def _write_outputs(self, outputs):
+        db = SessionLocal()
+        try:
+            try:
+                insert_message_rows(db, outputs)
+                db.commit()
+                self.transactions += 1
+                return
+            except Exception as e:
+                db.rollback()
+                print(f"Bulk write of {len(outputs)} users failed, retrying per user: {e!r}")
+
+            # チャンク単位で失敗した場合は、ユーザー単位で保存し直して影響を限定する
+            for output in outputs:
+                try:
+                    insert_message_rows(db, [output])
+                    db.commit()
+                    self.transactions += 1
+                except Exception as e:
+                    db.rollback()
+                    self.failed_users.append(output[0])
+                    print(f"Error saving messages for user {output[0].user_name}: {e!r}")
+        finally:
+            db.close()
+
+# 1ユーザー分のメッセージを生成する関数（すべてのコーピングのアドバイスを生成できたかどうかも返す）
+async def build_user_messages(user, yesterdays_score, todays_score, score_id, has_coping_results):
+    # コーピングマスタに照合
+    coping_lists = fetch_all_coping_lists(score_id, time_values)
+
+    # assistant_messageを生成
+    assistant_message = get_assistant_content(score_id)
+
+    # GPTにアクセス
+    with metrics.batch_stage_duration.time(stage='generate_advice'):
+        advice_lists = await generate_gpt_response(coping_lists)
+
+    # 今回生成したcoping_messageも満足度ありで保存されるため、coping_resultsに含める
+    coping_results = has_coping_results or bool(advice_lists)
+
+    # daily_messageの生成
+    daily_message_text = generate_daily_message_text(coping_results, todays_score, yesterdays_score)
+
+    coping_rows, daily_row = build_message_rows(user.user_id, assistant_message, advice_lists, daily_message_text, yesterdays_score, todays_score)
+    return coping_rows, daily_row, len(advice_lists) == len(coping_lists)
+
+# 1ユーザー分の処理を行う関数。結果として"success"/"partial"/"unchanged"/"skipped"/"failed"を返す
+# （fingerprintsに今日の実行と同じ入力が記録されているユーザーは、forceでない限りメッセージを作り直さない）
+# （GPTの失敗で一部のアドバイスを生成できなかった場合は"partial"とし、次回の実行で作り直すようフィンガープリントを保存しない）
+async def process_user(user, scores, semaphore: asyncio.Semaphore, writer: MessageWriter, coping_result_user_ids, fingerprints=None, force: bool = False):
+    async with semaphore:
+        try:
+            # 認証情報ごとに取得済みのスコアを利用
+            yesterdays_score, todays_score = scores
+            if todays_score is None:
+                return "skipped"
+
+            # スコアIDの計算
+            score_id = calculate_score_id(todays_score)
+            if score_id is None:
+                print(f"{user.user_name}のスコアIDはありません")
+                return "skipped"
+
+            # 入力が前回の実行と同じであれば、保存済みのメッセージをそのまま使う
+            fingerprint = input_fingerprint(yesterdays_score, todays_score, score_id)
+            if not force and fingerprints and fingerprints.get(user.user_id) == fingerprint:
+                return "unchanged"
+
+            # scoreとscore_idを出力
+            print(f"User: {user.user_name}, Score: {todays_score}, Score ID: {score_id}")
+
+            # メッセージを生成し、まとめて保存するためにwriterへ渡す
+            coping_rows, daily_row, complete = await build_user_messages(
+                user, yesterdays_score, todays_score, score_id, user.user_id in coping_result_user_ids
+            )
+            await writer.add(user, coping_rows, daily_row, fingerprint if complete else None)
+            return "success" if complete else "partial"
 
+        # 1ユーザーの失敗が他のユーザーの処理に影響しないようにする
+        except Exception as e:
+            print(f"Error processing user {user.user_name}: {e!r}")
+            return "failed"
+
+# 同時実行数をコネクションプールの上限に収める関数
+# （ユーザーごとに最大1本、メッセージの一括保存に1本のコネクションを使う。max_overflowが負の場合は上限なし）
+def clamp_concurrency(concurrency: int):
+    concurrency = max(1, concurrency)
+    if DB_MAX_OVERFLOW < 0:
+        return concurrency
+    capacity = DB_POOL_SIZE + DB_MAX_OVERFLOW
+    if capacity < 2:
+        raise ValueError(
+            f"DB pool capacity (DB_POOL_SIZE + DB_MAX_OVERFLOW = {capacity}) must be at least 2 to run the batch"
+        )
+    if concurrency > capacity - 1:
+        print(
+            f"Concurrency {concurrency} exceeds the DB pool capacity "
+            f"(DB_POOL_SIZE={DB_POOL_SIZE} + DB_MAX_OVERFLOW={DB_MAX_OVERFLOW}); using {capacity - 1}. "
+            f"Raise DB_POOL_SIZE/DB_MAX_OVERFLOW to run more users at once."
+        )
+        return capacity - 1
+    return concurrency
+
+# ユーザーをOuraAPIキーごとにまとめる関数
+def group_users_by_api_key(users):
+    groups = {}
+    skipped = 0
     for user in users:
-        # APIキーの選択
         api_key = select_api_key(user)
         if api_key is None:
+            skipped += 1
             continue
+        groups.setdefault(api_key, []).append(user)
+    return groups, skipped
 
-        # APIからスコアを取得
-        yesterdays_score, todays_score = fetch_daily_readiness(api_key)
-        if todays_score is None:
-            continue
+# 認証情報ごとに、前回の取り込み以降の心拍数サンプルを取得して保存する関数。新しく保存したサンプル数を返す
+async def sync_heart_rate(groups):
+    now = datetime.now(timezone.utc)
+    earliest = now - timedelta(days=HEART_RATE_BACKFILL_DAYS)
 
-        # スコアIDの計算
-        score_id = calculate_score_id(todays_score)
-        if score_id is None:
-            print(f"{user.user_name}のスコアIDはありません")
-            continue
-
-        # scoreとscore_idを出力
-        print(f"User: {user.user_name}")
-        print(f"Score: {todays_score}")
-        print(f"Score ID: {score_id}")
-
-        # コーピングマスタに照合
-        coping_lists = fetch_all_coping_lists(db, score_id, time_values)
-
-        # assistant_messageを生成
-        assistant_message = get_assistant_content(score_id)
-
-        # GPTにアクセス
-        advice_lists = generate_gpt_response(coping_lists)
-
-        # advice_listごとに保存
-        for advice_list in advice_lists:
-            save_coping_message(db, user.user_id, assistant_message, advice_list)
-            print(advice_list)
-            print("-" * 50)
+    def latest_timestamps():
+        db = SessionLocal()
+        try:
+            return {
+                oura_id: heart_rate_store.latest_timestamp(db, oura_id)
+                for group in groups.values()
+                for oura_id in {user.oura_id for user in group}
+            }
+        finally:
+            db.close()
+
+    def save(oura_ids, samples):
+        db = SessionLocal()
+        try:
+            return sum(heart_rate_store.save_samples(db, oura_id, samples) for oura_id in oura_ids)
+        finally:
+            db.close()
+
+    latest = await asyncio.to_thread(latest_timestamps)
+
+    async def sync(api_key, group):
+        oura_ids = {user.oura_id for user in group}
+        starts = [latest[oura_id] or earliest for oura_id in oura_ids]
+        samples = await oura_client.fetch_heart_rate_range(api_key, max(earliest, min(starts)), now)
+        if not samples:
+            return 0
+        try:
+            return await asyncio.to_thread(save, oura_ids, samples)
+        except Exception as e:
+            print(f"Error saving heart rate samples: {e!r}")
+            return 0
 
-        # クエリの実行
-        coping_results = get_coping_results(db, user.user_id, today_date)
+    return sum(await asyncio.gather(*(sync(api_key, group) for api_key, group in groups.items())))
 
-        # 取得したコーピングメッセージの表示
-        for coping in coping_results:
-            print(f'当てはまるcoping_messageは{coping.coping_message_text, coping.satisfaction_score}')
+async def run(concurrency: int = BATCH_CONCURRENCY, chunk_size: int = BATCH_WRITE_CHUNK_SIZE, metrics_output: str = BATCH_METRICS_OUTPUT, force: bool = False):
+    run_start = time.perf_counter()
+    concurrency = clamp_concurrency(concurrency)
 
-        # daily_messageの生成
-        daily_message_text = generate_daily_message_text(coping_results, todays_score, yesterdays_score)
+    # アドバイスキャッシュ・スナップショット・心拍数・フィンガープリントのテーブルを用意し、期限切れのキャッシュを削除
+    Base.metadata.create_all(bind=engine, tables=[
+        AdviceCache.__table__, ConditionSnapshot.__table__, HeartRateDay.__table__, BatchFingerprint.__table__
+    ])
 
-        # daily_messagesテーブルにdaily_messageを格納
-        save_daily_message(db, user.user_id, daily_message_text, yesterdays_score, todays_score)
+    # すべてのユーザーを取得
+    db = SessionLocal()
+    setup_start = time.perf_counter()
+    try:
+        pruned = advice_cache.prune_advice_cache(db)
+        if pruned:
+            print(f"Pruned {pruned} expired advice cache entries")
+        # コーピングマスタをメモリに読み込む（変更がなければ読み込み済みのものを使う）
+        coping_master_index.refresh_if_stale(db)
+        users = db.query(User).all()
+        coping_result_user_ids = get_coping_result_user_ids(db, today_date)
+        fingerprints = {} if force else load_fingerprints(db)
+    finally:
+        db.close()
+    metrics.batch_stage_duration.observe(time.perf_counter() - setup_start, stage='load_users')
 
-    # セッションのクローズ
-    db_gen.close()
+    # 同じAPIキーのユーザーは同じデータになるため、キーごとに1回だけスコアを取得する
+    groups, skipped = group_users_by_api_key(users)
+    try:
+        # Oura Webhookでスナップショットを更新している場合は、取得済みのキーはOuraに問い合わせない
+        # （有効かどうかはAPIと同じ設定から判定する）
+        snapshot_readiness = load_snapshot_readiness(groups) if get_settings().oura_webhook_enabled else {}
+        api_keys = [api_key for api_key in groups if api_key not in snapshot_readiness]
+        with metrics.batch_stage_duration.time(stage='fetch_readiness'):
+            readiness = await asyncio.gather(*(fetch_daily_readiness(api_key) for api_key in api_keys))
+        fetched = dict(zip(api_keys, readiness))
+        readiness_by_key = {**snapshot_readiness, **fetched}
+        scores_by_key = {api_key: extract_scores(entries) for api_key, entries in readiness_by_key.items()}
+
+        # 取得したcontributorsの内訳をスナップショットとして保存
+        with metrics.batch_stage_duration.time(stage='save_snapshots'):
+            snapshots = save_condition_snapshots({api_key: groups[api_key] for api_key in fetched}, fetched)
+
+        # 心拍数サンプルの差分を取り込む（取り込みに失敗してもメッセージの生成は続ける）
+        heart_rate_samples = 0
+        if HEART_RATE_BACKFILL_DAYS > 0:
+            with metrics.batch_stage_duration.time(stage='sync_heart_rate'):
+                try:
+                    heart_rate_samples = await sync_heart_rate(groups)
+                except Exception as e:
+                    print(f"Error syncing heart rate samples: {e!r}")
+
+        # ユーザーごとの処理を同時実行数を制限して並行に実行
+        semaphore = asyncio.Semaphore(concurrency)
+        writer = MessageWriter(chunk_size)
+        with metrics.batch_stage_duration.time(stage='process_users'):
+            results = await asyncio.gather(*(
+                process_user(user, scores_by_key[api_key], semaphore, writer, coping_result_user_ids, fingerprints, force)
+                for api_key, group in groups.items()
+                for user in group
+            ))
+
+            # 残りの出力を保存
+            await writer.flush()
+
+        # 保存に失敗したユーザーは"failed"として数える
+        failed_user_ids = {user.user_id for user in writer.failed_users}
+        processed_users = [user for group in groups.values() for user in group]
+        results = [
+            "failed" if user.user_id in failed_user_ids else result
+            for user, result in zip(processed_users, results)
+        ]
+    finally:
+        # OuraAPI・GPTクライアントのクローズ
+        await oura_client.close_client()
+        await close_gpt_client()
+
+    # 実行結果のサマリーを出力
+    eligible_users = sum(len(group) for group in groups.values())
+    print(
+        f"Processed {len(users)} users (concurrency={concurrency}): "
+        f"success={results.count('success')}, partial={results.count('partial')}, "
+        f"unchanged={results.count('unchanged')}, skipped={results.count('skipped') + skipped}, "
+        f"failed={results.count('failed')}"
+    )
+    print(f"Message writes: {writer.transactions} transactions (chunk_size={writer.chunk_size})")
+    print(
+        f"Oura readiness calls: {len(api_keys)} for {eligible_users} users "
+        f"(saved {eligible_users - len(api_keys)} calls)"
+    )
+    metrics.batch_stage_duration.observe(time.perf_counter() - run_start, stage='total')
+
+    # 実行ごとのメトリクスのサマリーをJSONで出力
+    summary = {
+        "date": today_date,
+        "users": len(users),
+        "success": results.count('success'),
+        "partial": results.count('partial'),
+        "unchanged": results.count('unchanged'),
+        "skipped": results.count('skipped') + skipped,
+        "failed": results.count('failed'),
+        "write_transactions": writer.transactions,
+        "force": force,
+        "oura_readiness_calls": len(api_keys),
+        "condition_snapshots": snapshots,
+        "heart_rate_samples": heart_rate_samples,
+    }
+    print(json.dumps({**summary, "metrics": metrics.snapshot()}, ensure_ascii=False, default=str))
+    if metrics_output:
+        metrics.write_json(metrics_output, summary)
+    return results
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="daily_messageとcoping_messageを生成するバッチ")
+    parser.add_argument("--concurrency", type=int, default=BATCH_CONCURRENCY, help="同時に処理するユーザー数")
+    parser.add_argument("--chunk-size", type=int, default=BATCH_WRITE_CHUNK_SIZE, help="1トランザクションで保存するユーザー数")
+    parser.add_argument("--metrics-output", default=BATCH_METRICS_OUTPUT, help="実行サマリー（メトリクス）を書き出すJSONファイル")
+    parser.add_argument("--force", action="store_true", help="入力が前回の実行と同じユーザーもメッセージを作り直す")
+    args = parser.parse_args(argv)
+    asyncio.run(run(args.concurrency, args.chunk_size, args.metrics_output, args.force))
 
 if __name__ == "__main__":
     main()
-
-
-
-
-
-
-
@@ -1,26 +1,159 @@
 import os
+import ssl
+import time
+from threading import Lock
+from dotenv import load_dotenv
 from sqlalchemy import create_engine
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, AsyncSession
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import QueuePool, AsyncAdaptedQueuePool
+import metrics
+
+# .envファイルから環境変数を読み込む（接続先やプール設定を環境ごとに変えられるようにする）
+load_dotenv()
 
 # SSL証明書のパス
 base_path = os.path.dirname(os.path.abspath(__file__))
-ssl_cert_path = os.path.join(base_path, 'DigiCertGlobalRootG2.crt.pem')
+ssl_cert_path = os.getenv('DB_SSL_CA', os.path.join(base_path, 'DigiCertGlobalRootG2.crt.pem'))
 
-# MySQLの接続URLにSSLオプションを追加
-DATABASE_URL = (
-    "mysql+mysqlconnector://tech0gen7student:vY7JZNfU"
+# 既定の接続先（環境変数で上書きしない場合に使う）
+DEFAULT_DB_LOCATION = (
+    "tech0gen7student:vY7JZNfU"
     "@tech0-db-step4-studentrdb-2.mysql.database.azure.com/heattech_app"
-    "?ssl_ca={}".format(ssl_cert_path)
 )
 
-# SQLAlchemyエンジンの作成
-engine = create_engine(DATABASE_URL, echo=True)
+# MySQLの接続URLにSSLオプションを追加
+DATABASE_URL = os.getenv(
+    'DATABASE_URL',
+    "mysql+mysqlconnector://{}?ssl_ca={}".format(DEFAULT_DB_LOCATION, ssl_cert_path)
+)
 
-# セッションの作成
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+# 非同期ドライバ（aiomysql）用の接続URL。SSLはconnect_argsで証明書を指定する
+ASYNC_DATABASE_URL = os.getenv('ASYNC_DATABASE_URL', "mysql+aiomysql://{}".format(DEFAULT_DB_LOCATION))
 
-# ベースクラスの宣言
-Base = declarative_base()
+# 読み取り専用のエンドポイントで使うリードレプリカの接続URL（未設定の場合はプライマリを使う）
+ASYNC_READ_DATABASE_URL = os.getenv('ASYNC_READ_DATABASE_URL')
+
+# 環境変数の真偽値を読み取る関数
+def _env_bool(name: str, default: bool):
+    value = os.getenv(name)
+    if value is None:
+        return default
+    return value.lower() in ('1', 'true', 'yes', 'on')
+
+# コネクションプールの設定（SQLのログ出力は既定で無効）
+DB_ECHO = _env_bool('DB_ECHO', False)
+DB_POOL_SIZE = int(os.getenv('DB_POOL_SIZE', '5'))
+DB_MAX_OVERFLOW = int(os.getenv('DB_MAX_OVERFLOW', '10'))
+DB_POOL_TIMEOUT = float(os.getenv('DB_POOL_TIMEOUT', '30'))
+DB_POOL_RECYCLE = int(os.getenv('DB_POOL_RECYCLE', '1800'))
+DB_POOL_PRE_PING = _env_bool('DB_POOL_PRE_PING', True)
+
+# コネクション取得の待ち時間を集計するクラス
+class PoolWaitStats:
+    def __init__(self, name: str):
+        self.name = name
+        self.count = 0
+        self.total_seconds = 0.0
+        self.max_seconds = 0.0
+        self._lock = Lock()
+
+    def record(self, seconds: float):
+        with self._lock:
+            self.count += 1
+            self.total_seconds += seconds
+            self.max_seconds = max(self.max_seconds, seconds)
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                "checkouts": self.count,
+                "wait_seconds_total": self.total_seconds,
+                "wait_seconds_avg": self.total_seconds / self.count if self.count else 0.0,
+                "wait_seconds_max": self.max_seconds
+            }
 
+# コネクション取得時間を計測するプールクラスを作る関数
+# （プールの作り直し時も同じクラスが使われるため、統計はクラス属性に持たせる）
+def _instrumented_pool_class(base, stats: PoolWaitStats):
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            return base._do_get(self)
+        finally:
+            stats.record(time.perf_counter() - start)
+    return type(f"Instrumented{base.__name__}", (base,), {"_do_get": _do_get, "wait_stats": stats})
 
+# 計測対象のエンジン一覧（名前: エンジン）
+_engines = {}
+
+# 環境変数の設定に従ってエンジンを作成する関数
+def create_db_engine(name: str, url: str, is_async: bool = False):
+    stats = PoolWaitStats(name)
+    kwargs = {
+        "echo": DB_ECHO,
+        "poolclass": _instrumented_pool_class(AsyncAdaptedQueuePool if is_async else QueuePool, stats),
+        "pool_size": DB_POOL_SIZE,
+        "max_overflow": DB_MAX_OVERFLOW,
+        "pool_timeout": DB_POOL_TIMEOUT,
+        "pool_recycle": DB_POOL_RECYCLE,
+        "pool_pre_ping": DB_POOL_PRE_PING,
+    }
+    if is_async:
+        # aiomysqlはURLでSSLを指定できないため、証明書を読み込んだSSLContextを渡す
+        if url.startswith("mysql+aiomysql"):
+            kwargs["connect_args"] = {"ssl": ssl.create_default_context(cafile=ssl_cert_path)}
+        engine = create_async_engine(url, **kwargs)
+        _engines[name] = engine.sync_engine
+    else:
+        engine = create_engine(url, **kwargs)
+        _engines[name] = engine
+    # SQLの実行回数・時間を計測する（SQLのログ出力の代わり）
+    metrics.instrument_engine(_engines[name], name)
+    return engine
+
+# コネクションプールの状態を返す関数
+def pool_stats():
+    stats = {}
+    for name, engine in _engines.items():
+        pool = engine.pool
+        stats[name] = {
+            "size": pool.size(),
+            "checked_in": pool.checkedin(),
+            "checked_out": pool.checkedout(),
+            "overflow": pool.overflow(),
+            **pool.wait_stats.snapshot()
+        }
+    return stats
+
+# 同期エンジンとセッション（バッチ・スクリプト用）
+# APIサーバーでは使わないため、mysql.connectorの読み込みを避けて最初に参照されたときに作成する
+_sync_objects = {}
+
+def _get_sync_objects():
+    if not _sync_objects:
+        sync_engine = create_db_engine("primary", DATABASE_URL)
+        _sync_objects["engine"] = sync_engine
+        _sync_objects["SessionLocal"] = sessionmaker(autocommit=False, autoflush=False, bind=sync_engine)
+    return _sync_objects
+
+# engine・SessionLocalの参照時に同期エンジンを作成する（from db.db_config import engine でも動作する）
+def __getattr__(name):
+    if name in ("engine", "SessionLocal"):
+        return _get_sync_objects()[name]
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+# APIサーバー用の非同期エンジンとセッションの作成（バッチは同期版を使う）
+async_engine = create_db_engine("primary_async", ASYNC_DATABASE_URL, is_async=True)
+AsyncSessionLocal = async_sessionmaker(bind=async_engine, class_=AsyncSession, autoflush=False, expire_on_commit=False)
+
+# 読み取り専用セッションの作成（リードレプリカがなければプライマリと同じ）
+if ASYNC_READ_DATABASE_URL:
+    async_read_engine = create_db_engine("replica_async", ASYNC_READ_DATABASE_URL, is_async=True)
+else:
+    async_read_engine = async_engine
+AsyncReadSessionLocal = async_sessionmaker(bind=async_read_engine, class_=AsyncSession, autoflush=False, expire_on_commit=False)
+
+# ベースクラスの宣言
+Base = declarative_base()
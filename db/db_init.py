@@ -1,6 +1,29 @@
+from sqlalchemy import inspect
 from .db_config import engine, Base
 
 def initialize_database():
+    # モデルを読み込んでテーブル定義を登録
+    import models  # noqa: F401
+
     # テーブルを作成
     Base.metadata.create_all(bind=engine)
+    # 既存テーブルに後から追加したインデックスを作成
+    migrate_indexes()
     print("Database and tables initialized successfully")
+
+# モデルに定義されているが、既存テーブルにまだないインデックスを作成する関数
+def migrate_indexes():
+    inspector = inspect(engine)
+    existing_tables = set(inspector.get_table_names())
+    for table in Base.metadata.sorted_tables:
+        if table.name not in existing_tables:
+            continue
+        existing_indexes = {index['name'] for index in inspector.get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name not in existing_indexes:
+                index.create(bind=engine)
+                print(f"Created index {index.name} on {table.name}")
+
+# スキーマ作成・マイグレーションの実行（python -m db.db_init）
+if __name__ == "__main__":
+    initialize_database()
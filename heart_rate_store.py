@@ -0,0 +1,152 @@
+from datetime import datetime, timezone
+from sqlalchemy import func, insert, select, update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+from models import HeartRateDay, jst_now
+
+# 1日の秒数（サンプルはUTCの日付ごとに1行にまとめる）
+DAY_SECONDS = 86400
+
+# numpyはAPIの起動を遅くしないよう、使うときに読み込む
+def _np():
+    import numpy
+    return numpy
+
+# Ouraのtimestamp文字列をUNIX時間（秒）に変換する関数
+def _epoch(value: str):
+    return int(datetime.fromisoformat(value.replace('Z', '+00:00')).timestamp())
+
+# 日番号（UNIX時間 // 1日の秒数）を日付文字列に変換する関数
+def _day_str(day_number: int):
+    return datetime.fromtimestamp(day_number * DAY_SECONDS, timezone.utc).strftime('%Y-%m-%d')
+
+# Ouraの心拍数サンプルをUNIX時間と心拍数の配列に変換する関数
+def samples_to_arrays(samples):
+    np = _np()
+    valid = [sample for sample in samples if sample.get('bpm') is not None and sample.get('timestamp')]
+    timestamps = np.array([_epoch(sample['timestamp']) for sample in valid], dtype=np.int64)
+    bpms = np.clip(np.array([sample['bpm'] for sample in valid], dtype=np.int64), 0, 255).astype(np.uint8)
+    return timestamps, bpms
+
+# 保存されている1日分の配列をUNIX時間と心拍数の配列に戻す関数
+def _decode(row):
+    np = _np()
+    day_start = int(datetime.strptime(row.day, '%Y-%m-%d').replace(tzinfo=timezone.utc).timestamp())
+    timestamps = np.frombuffer(row.offsets, dtype='<i4').astype(np.int64) + day_start
+    return timestamps, np.frombuffer(row.bpms, dtype=np.uint8)
+
+# 2つのサンプル列をまとめる関数（同じ時刻のサンプルは先に渡した方を優先し、時刻順に並べる）
+def _merge(timestamps, bpms, other_timestamps, other_bpms):
+    np = _np()
+    merged, index = np.unique(np.concatenate([timestamps, other_timestamps]), return_index=True)
+    return merged, np.concatenate([bpms, other_bpms])[index]
+
+# 心拍数サンプルを日付ごとの配列にまとめて保存する関数。新しく追加したサンプル数を返す
+def save_samples(db: Session, oura_id: int, samples):
+    np = _np()
+    timestamps, bpms = samples_to_arrays(samples)
+    if not len(timestamps):
+        return 0
+    day_numbers = timestamps // DAY_SECONDS
+    days = {int(day_number): _day_str(int(day_number)) for day_number in np.unique(day_numbers)}
+
+    for attempt in range(2):
+        try:
+            # 同じ日の行を同時に更新して一方のサンプルが失われないよう、既存の行をロックしてからまとめる
+            existing = {
+                row.day: row for row in db.execute(select(
+                    HeartRateDay.heart_rate_day_id, HeartRateDay.day, HeartRateDay.sample_count,
+                    HeartRateDay.offsets, HeartRateDay.bpms
+                ).filter(
+                    HeartRateDay.oura_id == oura_id,
+                    HeartRateDay.day.in_(days.values())
+                ).with_for_update())
+            }
+
+            now = jst_now()
+            updates, inserts = [], []
+            added = 0
+            for day_number, day in days.items():
+                mask = day_numbers == day_number
+                row = existing.get(day)
+                old_timestamps, old_bpms = _decode(row) if row is not None else (timestamps[:0], bpms[:0])
+                day_timestamps, day_bpms = _merge(timestamps[mask], bpms[mask], old_timestamps, old_bpms)
+                # 新しいサンプルがない日は書き込まない
+                if row is not None and len(day_timestamps) == row.sample_count:
+                    continue
+                added += len(day_timestamps) - (row.sample_count if row is not None else 0)
+
+                values = {
+                    "oura_id": oura_id,
+                    "day": day,
+                    "sample_count": len(day_timestamps),
+                    "last_timestamp": int(day_timestamps[-1]),
+                    "offsets": (day_timestamps - day_number * DAY_SECONDS).astype('<i4').tobytes(),
+                    "bpms": day_bpms.astype(np.uint8).tobytes(),
+                    "update_datetime": now
+                }
+                if row is not None:
+                    updates.append({**values, "heart_rate_day_id": row.heart_rate_day_id})
+                else:
+                    inserts.append({**values, "create_datetime": now})
+
+            if updates:
+                db.execute(update(HeartRateDay), updates)
+            if inserts:
+                db.execute(insert(HeartRateDay), inserts)
+            db.commit()
+            return added
+        except IntegrityError:
+            # 別のプロセスが同じ日の行を先に追加した場合は、まとめ直してやり直す
+            db.rollback()
+            if attempt:
+                raise
+
+# 保存済みの最新サンプルの日時を返す関数（差分だけを取得するために使う）
+def latest_timestamp(db: Session, oura_id: int):
+    value = db.execute(select(func.max(HeartRateDay.last_timestamp)).filter(HeartRateDay.oura_id == oura_id)).scalar()
+    return datetime.fromtimestamp(value, timezone.utc) if value is not None else None
+
+# 指定期間（UNIX時間、終了は含まない）のサンプルを読み込む関数
+def load_samples(db: Session, oura_id: int, start: int, end: int):
+    np = _np()
+    rows = db.execute(select(HeartRateDay.day, HeartRateDay.offsets, HeartRateDay.bpms).filter(
+        HeartRateDay.oura_id == oura_id,
+        HeartRateDay.day >= _day_str(start // DAY_SECONDS),
+        HeartRateDay.day <= _day_str((end - 1) // DAY_SECONDS)
+    ).order_by(HeartRateDay.day)).all()
+    if not rows:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.uint8)
+
+    decoded = [_decode(row) for row in rows]
+    timestamps = np.concatenate([timestamps for timestamps, _ in decoded])
+    bpms = np.concatenate([bpms for _, bpms in decoded])
+    mask = (timestamps >= start) & (timestamps < end)
+    return timestamps[mask], bpms[mask]
+
+# サンプルを指定した間隔（秒）ごとに集計し、最小・平均・最大を返す関数（サンプルは時刻順であること）
+def aggregate(timestamps, bpms, start: int, resolution: int):
+    np = _np()
+    if not len(timestamps):
+        return []
+    bucket_numbers, first, counts = np.unique((timestamps - start) // resolution, return_index=True, return_counts=True)
+    values = bpms.astype(np.float64)
+    mins = np.minimum.reduceat(values, first)
+    maxs = np.maximum.reduceat(values, first)
+    means = np.add.reduceat(values, first) / counts
+    return [
+        {
+            "start": datetime.fromtimestamp(start + int(bucket_number) * resolution, timezone.utc),
+            "min": int(minimum),
+            "mean": round(float(mean), 1),
+            "max": int(maximum),
+            "count": int(count)
+        }
+        for bucket_number, minimum, mean, maximum, count in zip(bucket_numbers, mins, means, maxs, counts)
+    ]
+
+# 指定期間の心拍数を間隔ごとに集計して返す関数（非同期セッションからはrun_syncで呼ぶ）
+def bucket_history(db: Session, oura_id: int, start: datetime, end: datetime, resolution: int):
+    start_epoch, end_epoch = int(start.timestamp()), int(end.timestamp())
+    timestamps, bpms = load_samples(db, oura_id, start_epoch, end_epoch)
+    return aggregate(timestamps, bpms, start_epoch, resolution)
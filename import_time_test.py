@@ -0,0 +1,54 @@
+import os
+import re
+import statistics
+import subprocess
+import sys
+
+# 計測対象のモジュールと目標時間（ミリ秒）
+target_module = os.getenv('IMPORT_TIME_MODULE', 'main')
+target_ms = float(os.getenv('IMPORT_TIME_TARGET_MS', '1500'))
+repeat = int(os.getenv('IMPORT_TIME_REPEAT', '5'))
+
+# 起動時に読み込まれると困る重いモジュール
+forbidden_modules = ['pandas', 'openai', 'mysql.connector', 'numpy']
+
+# -X importtime の出力行（"import time: self | cumulative | module"）
+line_pattern = re.compile(r'^import time:\s+(\d+)\s+\|\s+(\d+)\s+\|(\s*)(\S+)')
+
+# 新しいプロセスでモジュールを読み込み、各モジュールの累積読み込み時間（マイクロ秒）を返す関数
+def measure_once():
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', f'import {target_module}'],
+        capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__))
+    )
+    if result.returncode != 0:
+        print(result.stderr[-2000:])
+        raise SystemExit(f"Failed to import {target_module}")
+
+    cumulative = {}
+    for line in result.stderr.splitlines():
+        match = line_pattern.match(line)
+        if match:
+            cumulative[match.group(4)] = int(match.group(2))
+    return cumulative
+
+samples = [measure_once() for _ in range(repeat)]
+totals_ms = [sample[target_module] / 1000 for sample in samples]
+median_ms = statistics.median(totals_ms)
+
+# 読み込みに時間がかかっているトップレベルのモジュールを表示
+slowest = sorted(
+    ((name, us) for name, us in samples[-1].items() if '.' not in name and name != target_module),
+    key=lambda item: item[1], reverse=True
+)[:10]
+
+print(f"import {target_module}: median {median_ms:.1f} ms over {repeat} runs (target {target_ms:.0f} ms)")
+for name, us in slowest:
+    print(f"  {name:<30} {us / 1000:8.1f} ms")
+
+loaded_forbidden = [name for name in forbidden_modules if name in samples[-1]]
+if loaded_forbidden:
+    print(f"Heavy modules imported at startup: {', '.join(loaded_forbidden)}")
+
+if median_ms > target_ms or loaded_forbidden:
+    sys.exit(1)
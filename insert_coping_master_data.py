@@ -1,65 +1,130 @@
-from sqlalchemy import Column, Integer, String, DateTime
-from sqlalchemy.orm import Session
-from datetime import datetime
-import pytz
+import argparse
 import pandas as pd
-from passlib.context import CryptContext
-from db.db_config import Base, engine, SessionLocal  # db_configからインポート
+from sqlalchemy import delete, insert, update
+from sqlalchemy.orm import Session
+from db.db_config import SessionLocal  # db_configからインポート
+from models import CopingMaster, jst_now  # models.pyからインポート
+
+# CSVに必要なカラム
+REQUIRED_COLUMNS = ['type_no', 'type_name', 'score_id', 'time', 'tone', 'rest_type', 'how_to_rest']
+INT_COLUMNS = ['type_no', 'score_id', 'time']
+STR_COLUMNS = ['type_name', 'tone', 'rest_type', 'how_to_rest']
+
+# 行を識別するカラム（同じ内容の行が複数ある場合は出現順(occurrence)で区別する）
+KEY_COLUMNS = ['type_name', 'score_id', 'time', 'rest_type', 'how_to_rest', 'occurrence']
+
+# 更新対象となるカラム
+VALUE_COLUMNS = ['type_no', 'tone']
+
+# 同じキーの行に出現順の番号を振る関数
+def add_occurrence(data: pd.DataFrame):
+    data['occurrence'] = data.groupby(KEY_COLUMNS[:-1], sort=False).cumcount()
+    return data
+
+# CSVの内容をまとめて検証・整形する関数。不正な行があればValueErrorを送出する
+def validate_master(data: pd.DataFrame):
+    missing = [column for column in REQUIRED_COLUMNS if column not in data.columns]
+    if missing:
+        raise ValueError(f"Missing columns: {', '.join(missing)}")
+
+    data = data[REQUIRED_COLUMNS].copy()
+    for column in STR_COLUMNS:
+        data[column] = data[column].astype('string').str.strip()
+    for column in INT_COLUMNS:
+        data[column] = pd.to_numeric(data[column], errors='coerce')
 
+    invalid = (
+        data[REQUIRED_COLUMNS].isna().any(axis=1)
+        | (data[STR_COLUMNS] == '').any(axis=1)
+        | ~data['score_id'].isin([1, 2, 3, 4])
+        | (data['time'] <= 0)
+    )
+    if invalid.any():
+        # CSVの行番号（ヘッダーが1行目）で報告する
+        raise ValueError(f"Invalid rows in CSV: {(data.index[invalid] + 2).tolist()}")
 
-# 日本時間（JST）を取得する関数
-def jst_now():
-    return datetime.now(pytz.timezone('Asia/Tokyo'))
+    data[INT_COLUMNS] = data[INT_COLUMNS].astype('int64')
+    return add_occurrence(data)
 
-class CopingMaster(Base):
-    __tablename__ = "coping_master"
+# 現在のコーピングマスタを読み込む関数
+def load_current_master(session: Session):
+    rows = session.query(CopingMaster).order_by(CopingMaster.coping_master_id).all()
+    current = pd.DataFrame(
+        [{column: getattr(row, column) for column in ['coping_master_id'] + REQUIRED_COLUMNS} for row in rows],
+        columns=['coping_master_id'] + REQUIRED_COLUMNS
+    )
+    # NULLはCSVのどの行とも一致しない値に置き換え、差分で置き換えられるようにする
+    for column in STR_COLUMNS:
+        current[column] = current[column].fillna('').astype('string')
+    current[INT_COLUMNS] = current[INT_COLUMNS].fillna(-1).astype('int64')
+    return add_occurrence(current)
 
-    coping_master_id = Column(Integer, primary_key=True, index=True, autoincrement=True)
-    type_no = Column(Integer)
-    type_name = Column(String(225))
-    score_id = Column(Integer)
-    time = Column(Integer)
-    tone = Column(String(225))
-    rest_type = Column(String(225))
-    how_to_rest = Column(String(225))
-    create_datetime = Column(DateTime, default=jst_now)
-    update_datetime = Column(DateTime, default=jst_now, onupdate=jst_now)
+# CSVとDBの差分（追加・更新・削除）を計算する関数
+def diff_master(new: pd.DataFrame, current: pd.DataFrame):
+    merged = new.merge(current, on=KEY_COLUMNS, how='outer', suffixes=('', '_current'), indicator=True)
 
-# テーブルの作成
-Base.metadata.create_all(bind=engine)
+    # 外部結合で欠損値が入り浮動小数になったカラムは整数に戻す
+    inserts = merged.loc[merged['_merge'] == 'left_only', REQUIRED_COLUMNS]
+    inserts = inserts.astype({column: 'int64' for column in INT_COLUMNS})
+    deletes = merged.loc[merged['_merge'] == 'right_only', 'coping_master_id'].astype('int64')
+
+    both = merged[merged['_merge'] == 'both']
+    changed = pd.Series(False, index=both.index)
+    for column in VALUE_COLUMNS:
+        changed |= (both[column] != both[f'{column}_current']).fillna(True).astype(bool)
+    updates = both.loc[changed, ['coping_master_id'] + VALUE_COLUMNS]
+    updates = updates.astype({'coping_master_id': 'int64', 'type_no': 'int64'})
+
+    return inserts, updates, deletes
+
+# 差分を1トランザクションでまとめて反映する関数（途中の状態がバッチから見えないようにする）
+def apply_diff(session: Session, inserts: pd.DataFrame, updates: pd.DataFrame, deletes: pd.Series):
+    now = jst_now()
+    try:
+        if len(deletes):
+            session.execute(delete(CopingMaster).where(CopingMaster.coping_master_id.in_(deletes.tolist())))
+        if len(updates):
+            update_rows = updates.assign(update_datetime=now).to_dict('records')
+            session.execute(update(CopingMaster), update_rows)
+        if len(inserts):
+            insert_rows = inserts.assign(create_datetime=now, update_datetime=now).to_dict('records')
+            session.execute(insert(CopingMaster), insert_rows)
+        session.commit()
+    except Exception:
+        session.rollback()
+        raise
 
 # CSVファイルからデータを読み込む関数
-def load_csv_to_db(csv_file_path, session: Session):
-    # CSVファイルを読み込む
-    data = pd.read_csv(csv_file_path)
-    
-    # 既存のデータを削除する
-    session.query(CopingMaster).delete()
-    session.commit()
-    
-    # データをCopingMasterインスタンスに変換
-    for index, row in data.iterrows():
-        record = CopingMaster(
-            type_no=row['type_no'],
-            type_name=row['type_name'],
-            score_id=row['score_id'],
-            time=row['time'],
-            tone=row['tone'],
-            rest_type=row['rest_type'],
-            how_to_rest=row['how_to_rest']
-        )
-        session.add(record)
-    
-    session.commit()
+def load_csv_to_db(csv_file_path, session: Session, dry_run: bool = False):
+    # CSVファイルを読み込んで検証する
+    new = validate_master(pd.read_csv(csv_file_path))
+
+    # 既存のデータとの差分を計算する
+    current = load_current_master(session)
+    inserts, updates, deletes = diff_master(new, current)
+    print(
+        f"coping_master: {len(new)} rows in CSV, {len(current)} rows in DB -> "
+        f"insert {len(inserts)}, update {len(updates)}, delete {len(deletes)}"
+    )
+
+    if dry_run or (inserts.empty and updates.empty and deletes.empty):
+        return inserts, updates, deletes
+
+    apply_diff(session, inserts, updates, deletes)
+    return inserts, updates, deletes
 
 # メインプログラム
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="coping_master.csvの内容をコーピングマスタに反映する")
+    parser.add_argument("csv_file_path", nargs="?", default='./coping_master.csv', help="CSVファイルのパス")
+    parser.add_argument("--dry-run", action="store_true", help="差分の表示のみ行い、DBは更新しない")
+    args = parser.parse_args()
+
     # データベースセッションの作成
     db = SessionLocal()
 
-    # CSVファイルからデータを読み込んで挿入
-    csv_file_path = './coping_master.csv'   # CSVファイルのパスを設定
-    load_csv_to_db(csv_file_path, db)
+    # CSVファイルからデータを読み込んで反映
+    load_csv_to_db(args.csv_file_path, db, args.dry_run)
 
     # セッションのクローズ
     db.close()
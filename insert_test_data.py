@@ -2,7 +2,7 @@ from sqlalchemy import Column, Integer, String, DateTime
 from sqlalchemy.orm import Session
 from datetime import datetime
 import pytz
-from passlib.context import CryptContext
+from password_hashing import hash_password
 from db.db_config import Base, engine, SessionLocal  # db_configからインポート
 from models import User  # models.pyからインポート
 
@@ -10,9 +10,6 @@ from models import User  # models.pyからインポート
 def jst_now():
     return datetime.now(pytz.timezone('Asia/Tokyo'))
 
-# パスワードのハッシュ化のための設定
-pwd_context = CryptContext(schemes=["argon2"], deprecated="auto")
-
 # テーブルの再作成
 Base.metadata.drop_all(bind=engine, tables=[Base.metadata.tables['users']])
 Base.metadata.create_all(bind=engine, tables=[Base.metadata.tables['users']])
@@ -22,7 +19,7 @@ test_data = [
     User(
         user_name="高橋晃",
         email="new_test1@example.com",
-        password=pwd_context.hash("password1"),
+        password=hash_password("password1"),
         oura_id=1,
         type_id=1,
         occupation_id="1",
@@ -31,7 +28,7 @@ test_data = [
     User(
         user_name="山下里佳",
         email="new_test2@example.com",
-        password=pwd_context.hash("password2"),
+        password=hash_password("password2"),
         oura_id=2,
         type_id=2,
         occupation_id="2",
@@ -40,7 +37,7 @@ test_data = [
     User(
         user_name="井上充",
         email="new_test3@example.com",
-        password=pwd_context.hash("password2"),
+        password=hash_password("password2"),
         oura_id=1,
         type_id=2,
         occupation_id="2",
@@ -49,7 +46,7 @@ test_data = [
     User(
         user_name="渡辺知実",
         email="new_test4@example.com",
-        password=pwd_context.hash("password2"),
+        password=hash_password("password2"),
         oura_id=1,
         type_id=2,
         occupation_id="2",
@@ -58,7 +55,7 @@ test_data = [
     User(
         user_name="林淳",
         email="new_test5@example.com",
-        password=pwd_context.hash("password2"),
+        password=hash_password("password2"),
         oura_id=2,
         type_id=2,
         occupation_id="2",
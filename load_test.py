@@ -0,0 +1,297 @@
+import argparse
+import asyncio
+import json
+import os
+import re
+import socket
+import statistics
+import subprocess
+import sys
+import time
+from datetime import datetime
+import httpx
+
+# APIエンドポイントの負荷試験
+# main:appをSQLite（またはローカルのMySQL）とOuraAPIのスタブに接続して起動し、
+# 各エンドポイントのスループットとレイテンシ（p50/p95/p99）をJSONに出力する
+# 実行例: python load_test.py --users 50 --concurrency 20 --requests 500 --oura-latency-ms 200
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+TEST_PASSWORD = "load-test-password"
+
+# 空いているポートを取得する関数
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+# 非同期ドライバのURLから、データ投入用の同期ドライバのURLを作る関数
+def to_sync_url(async_url: str):
+    return async_url.replace('sqlite+aiosqlite', 'sqlite').replace('mysql+aiomysql', 'mysql+mysqlconnector')
+
+# テスト用のユーザー・メッセージを投入し、ユーザーごとのcoping_message_idを返す関数
+# （指定したDBのテーブルは作り直されるため、負荷試験専用のDBを指定すること）
+def seed_database(async_url: str, sync_url: str, users: int):
+    # 接続先を差し替えてからモデルを読み込む
+    os.environ['DATABASE_URL'] = sync_url
+    os.environ['ASYNC_DATABASE_URL'] = async_url
+    from db.db_config import Base, engine, SessionLocal
+    from models import User, CopingMessage, DailyMessage
+    from password_hashing import hash_password
+
+    Base.metadata.drop_all(bind=engine)
+    Base.metadata.create_all(bind=engine)
+
+    # Argon2は遅いため、全ユーザーで同じハッシュを使う
+    password_hash = hash_password(TEST_PASSWORD)
+    now = datetime.now()
+    db = SessionLocal()
+    try:
+        db.add_all([
+            User(
+                user_name=f"load_user_{i}",
+                email=f"load_user_{i}@example.com",
+                password=password_hash,
+                oura_id=1 + i % 2,
+                type_id=1,
+                occupation_id="1",
+                overtime_id=20
+            )
+            for i in range(users)
+        ])
+        db.flush()
+
+        messages = {}
+        for user in db.query(User).all():
+            rows = [
+                CopingMessage(
+                    user_id=user.user_id,
+                    assistant_text="負荷試験用のメッセージです。",
+                    coping_message_text=f"負荷試験用のコーピング{n}",
+                    satisfaction_score="とても良い",
+                    heart_rate_before=0,
+                    heart_rate_after=0,
+                    create_datetime=now,
+                    update_datetime=now
+                )
+                for n in range(3)
+            ]
+            db.add_all(rows)
+            db.add(DailyMessage(
+                user_id=user.user_id,
+                daily_message_text="負荷試験用のデイリーメッセージです。",
+                previous_days_score=70,
+                todays_days_score=75,
+                create_datetime=now,
+                update_datetime=now
+            ))
+            db.flush()
+            messages[user.user_name] = [row.coping_message_id for row in rows]
+        db.commit()
+        return messages
+    finally:
+        db.close()
+        engine.dispose()
+
+# サーバーを起動し、応答するまで待つ関数
+def start_server(app_path: str, port: int, env: dict, ready_path: str):
+    process = subprocess.Popen(
+        [sys.executable, '-m', 'uvicorn', app_path, '--host', '127.0.0.1', '--port', str(port), '--log-level', 'warning'],
+        cwd=BASE_DIR, env=env
+    )
+    deadline = time.monotonic() + 60
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"{app_path} exited with code {process.returncode}")
+        try:
+            httpx.get(f"http://127.0.0.1:{port}{ready_path}", timeout=1)
+            return process
+        except httpx.HTTPError:
+            time.sleep(0.2)
+    process.terminate()
+    raise RuntimeError(f"{app_path} did not start within 60 seconds")
+
+# /metricsの出力からコネクションプールの状態（db_pool_*のゲージ）を取り出す関数
+def parse_pool_metrics(text: str):
+    pools = {}
+    for match in re.finditer(r'^db_pool_(\w+)\{engine="([^"]+)"\} (\S+)$', text, re.MULTILINE):
+        name, engine, value = match.groups()
+        pools.setdefault(engine, {})[name] = float(value)
+    return pools
+
+# レイテンシの一覧から統計値を計算する関数
+def summarize(latencies, errors: int, elapsed: float):
+    ordered = sorted(latencies)
+
+    def percentile(p):
+        if not ordered:
+            return None
+        index = min(len(ordered) - 1, max(0, round(p / 100 * len(ordered)) - 1))
+        return ordered[index] * 1000
+
+    return {
+        "requests": len(latencies) + errors,
+        "errors": errors,
+        "elapsed_seconds": elapsed,
+        "throughput_rps": len(latencies) / elapsed if elapsed else 0.0,
+        "latency_ms": {
+            "mean": statistics.fmean(ordered) * 1000 if ordered else None,
+            "p50": percentile(50),
+            "p95": percentile(95),
+            "p99": percentile(99),
+            "max": ordered[-1] * 1000 if ordered else None
+        }
+    }
+
+# 1つのシナリオ（エンドポイント）を指定した同時実行数で実行する関数
+async def run_scenario(name, make_request, total_requests: int, concurrency: int):
+    latencies = []
+    errors = 0
+    counter = iter(range(total_requests))
+
+    async def worker():
+        nonlocal errors
+        for i in counter:
+            start = time.perf_counter()
+            try:
+                response = await make_request(i)
+                ok = response.status_code < 400
+            except httpx.HTTPError:
+                ok = False
+            if ok:
+                latencies.append(time.perf_counter() - start)
+            else:
+                errors += 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    result = summarize(latencies, errors, time.perf_counter() - start)
+    p = result["latency_ms"]
+    print(
+        f"{name:<16} {result['throughput_rps']:8.1f} req/s  "
+        f"p50 {p['p50'] or 0:7.1f} ms  p95 {p['p95'] or 0:7.1f} ms  p99 {p['p99'] or 0:7.1f} ms  errors {errors}"
+    )
+    return result
+
+# 全シナリオを実行する関数
+async def drive(api_url: str, messages: dict, args):
+    limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+    async with httpx.AsyncClient(base_url=api_url, timeout=60, limits=limits) as client:
+        user_names = list(messages)
+
+        # ログイン（各ユーザーのトークンを取得してから計測する）
+        tokens = {}
+        for user_name in user_names:
+            response = await client.post('/token', data={"username": user_name, "password": TEST_PASSWORD})
+            response.raise_for_status()
+            tokens[user_name] = response.json()["access_token"]
+
+        def auth(i):
+            user_name = user_names[i % len(user_names)]
+            return user_name, {"Authorization": f"Bearer {tokens[user_name]}"}
+
+        async def token_request(i):
+            user_name = user_names[i % len(user_names)]
+            return await client.post('/token', data={"username": user_name, "password": TEST_PASSWORD})
+
+        async def condition_request(i):
+            return await client.get('/condition', headers=auth(i)[1])
+
+        async def coping_message_request(i):
+            return await client.get('/coping_message', headers=auth(i)[1])
+
+        async def coping_start_request(i):
+            user_name, headers = auth(i)
+            message_id = messages[user_name][i % 3]
+            return await client.post('/coping_start', headers=headers, json={"coping_message_id": message_id})
+
+        async def coping_finish_request(i):
+            user_name, headers = auth(i)
+            message_id = messages[user_name][i % 3]
+            return await client.post(
+                '/coping_finish', headers=headers,
+                json={"coping_message_id": message_id, "satisfaction_score": "とても良い"}
+            )
+
+        scenarios = {
+            "token": token_request,
+            "condition": condition_request,
+            "coping_message": coping_message_request,
+            "coping_start": coping_start_request,
+            "coping_finish": coping_finish_request,
+        }
+        results = {}
+        for name, make_request in scenarios.items():
+            if args.endpoints and name not in args.endpoints:
+                continue
+            # /tokenはArgon2の計算が重いため、リクエスト数を減らす
+            total = max(1, args.requests // 10) if name == "token" else args.requests
+            results[name] = await run_scenario(name, make_request, total, args.concurrency)
+        return results
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="APIエンドポイントの負荷試験")
+    parser.add_argument("--db-url", default=f"sqlite+aiosqlite:///{os.path.join(BASE_DIR, 'load_test.db')}", help="APIが使う非同期DBのURL（テーブルは作り直される）")
+    parser.add_argument("--sync-db-url", help="データ投入に使う同期DBのURL（省略時は--db-urlから作成）")
+    parser.add_argument("--users", type=int, default=20, help="テストユーザー数")
+    parser.add_argument("--concurrency", type=int, default=10, help="同時リクエスト数")
+    parser.add_argument("--requests", type=int, default=200, help="エンドポイントごとのリクエスト数")
+    parser.add_argument("--endpoints", nargs="*", help="計測するエンドポイント（省略時はすべて）")
+    parser.add_argument("--oura-latency-ms", type=float, default=100, help="OuraAPIスタブの応答遅延")
+    parser.add_argument("--heartrate-samples", type=int, default=120, help="心拍数スタブが返す最大サンプル数")
+    parser.add_argument("--output", default=os.path.join(BASE_DIR, 'load_test_result.json'), help="結果を出力するJSONファイル")
+    args = parser.parse_args(argv)
+
+    sync_url = args.sync_db_url or to_sync_url(args.db_url)
+    print(f"Seeding {args.users} users into {sync_url}")
+    messages = seed_database(args.db_url, sync_url, args.users)
+
+    stub_port, api_port = free_port(), free_port()
+    stub_env = {
+        **os.environ,
+        "STUB_LATENCY_MS": str(args.oura_latency_ms),
+        "STUB_HEARTRATE_SAMPLES": str(args.heartrate_samples),
+    }
+    api_env = {
+        **os.environ,
+        "ASYNC_DATABASE_URL": args.db_url,
+        "DATABASE_URL": sync_url,
+        "OURA_API_BASE_URL": f"http://127.0.0.1:{stub_port}",
+        "OURA_API_KEY_1": "load-test-key-1",
+        "OURA_API_KEY_2": "load-test-key-2",
+    }
+
+    stub = start_server('upstream_stub:app', stub_port, stub_env, '/_stats')
+    api = None
+    try:
+        api = start_server('main:app', api_port, api_env, '/metrics')
+        results = asyncio.run(drive(f"http://127.0.0.1:{api_port}", messages, args))
+        upstream_calls = httpx.get(f"http://127.0.0.1:{stub_port}/_stats").json()
+        pool = parse_pool_metrics(httpx.get(f"http://127.0.0.1:{api_port}/metrics").text)
+    finally:
+        if api is not None:
+            api.terminate()
+            api.wait()
+        stub.terminate()
+        stub.wait()
+
+    report = {
+        "timestamp": datetime.now().isoformat(timespec='seconds'),
+        "config": {
+            "db_url": args.db_url.split('@')[-1],
+            "users": args.users,
+            "concurrency": args.concurrency,
+            "requests": args.requests,
+            "oura_latency_ms": args.oura_latency_ms,
+            "heartrate_samples": args.heartrate_samples,
+        },
+        "endpoints": results,
+        "upstream_calls": upstream_calls,
+        "pool_stats": pool,
+    }
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"Results written to {args.output}")
+
+if __name__ == "__main__":
+    main()
@@ -1,27 +1,50 @@
-import requests
+import hmac
 import json
-import pandas as pd
-import mysql.connector
-from openai import OpenAI
 import os
-from fastapi import FastAPI, HTTPException, Request, Depends
+import time
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, HTTPException, Request, Depends, BackgroundTasks
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import PlainTextResponse
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
 from jose import JWTError, jwt
-from passlib.context import CryptContext
-from schemas import Token, UserCreate, UserInDB
+from schemas import Token, UserCreate, UserInDB, CopingMessageItem, CopingMessageResponse, Principal, HeartRateHistoryResponse
 from starlette.status import HTTP_401_UNAUTHORIZED
-from sqlalchemy.orm import Session
-from sqlalchemy import text, create_engine, func
-from models import CopingMessage, User, DailyMessage
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy import select, and_
+from models import CopingMessage, User, DailyMessage, ConditionSnapshot, day_range
 from typing import List, Optional
-from db.db_init import initialize_database
-from db.db_config import SessionLocal
-from datetime import datetime, timedelta
-from dotenv import load_dotenv
+from db.db_config import AsyncSessionLocal, AsyncReadSessionLocal, async_engine, async_read_engine, pool_stats
+from datetime import datetime, timedelta, timezone
 import pytz
-
-app = FastAPI()
+import oura_client
+import password_hashing
+from ttl_cache import TTLCache
+from settings import get_settings
+import metrics
+import condition_snapshot
+import oura_webhook
+import heart_rate_store
+
+# アプリの起動・終了時の処理
+# （スキーマ作成は起動時には行わず、python -m db.db_init で明示的に実行する）
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # 設定とOuraAPIクライアントを起動時に作成する
+    get_settings()
+    oura_client.get_client()
+    # Oura Webhookで通知されたドキュメントを取得するワーカーを起動する
+    oura_webhook.start_workers()
+    yield
+    # Webhookのワーカー・OuraAPIクライアントのコネクション・パスワードハッシュ用のプロセス・DBのプールを閉じる
+    await oura_webhook.stop_workers()
+    await oura_client.close_client()
+    password_hashing.shutdown_executor()
+    await async_engine.dispose()
+    if async_read_engine is not async_engine:
+        await async_read_engine.dispose()
+
+app = FastAPI(lifespan=lifespan)
 
 '''
 # CORSミドルウェアを追加
@@ -34,58 +57,72 @@ app.add_middleware(
 )
 '''
 
-
-initialize_database()
-
-# SQLAlchemyのDB接続
-def get_db():
-    db = SessionLocal()
+# ルートごとのレイテンシと、リクエストあたりのSQL実行回数・時間を記録するミドルウェア
+@app.middleware("http")
+async def record_request_metrics(request: Request, call_next):
+    db_stats, token = metrics.start_request_db_stats()
+    start = time.perf_counter()
+    status = 500
     try:
-        yield db
+        response = await call_next(request)
+        status = response.status_code
+        return response
     finally:
-        db.close()
+        # パスパラメータでラベルが増えないよう、URLではなくルートのパスで集計する
+        route = request.scope.get('route')
+        path = route.path if route is not None else 'unmatched'
+        metrics.http_request_duration.observe(
+            time.perf_counter() - start, method=request.method, route=path, status=str(status))
+        metrics.db_queries_per_request.observe(db_stats["queries"], route=path)
+        metrics.db_time_per_request.observe(db_stats["seconds"], route=path)
+        metrics.request_db_stats.reset(token)
+
+
+# SQLAlchemyのDB接続（非同期セッション）
+async def get_db():
+    async with AsyncSessionLocal() as db:
+        yield db
+
+# 読み取り専用のDB接続（リードレプリカが設定されていればそちらを使う）
+async def get_read_db():
+    async with AsyncReadSessionLocal() as db:
+        yield db
 
 # シークレットキーの設定
 SECRET_KEY = "your_secret_key"
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 30
 
-# .envファイルから環境変数を読み込む
-load_dotenv()
-
-# 環境変数からAPIキーを取得
-OURA_API_KEY_1 = os.getenv('OURA_API_KEY_1')
-OURA_API_KEY_2 = os.getenv('OURA_API_KEY_2')
-GPT_API_KEY = os.getenv('GPT_API_KEY')
+# Oura daily_readinessのキャッシュ（キー: (APIキー, 日付)）
+readiness_cache = TTLCache(
+    maxsize=int(os.getenv('READINESS_CACHE_MAXSIZE', '256')),
+    ttl=float(os.getenv('READINESS_CACHE_TTL', '600'))
+)
 
-# 日付に関する定義
-yesterday_date = (datetime.today() - timedelta(days=1)).strftime('%Y-%m-%d')
-today_date = datetime.today().strftime('%Y-%m-%d')
+# 旧形式のトークン（クレームにuser_idを含まない）で認証したユーザー情報のキャッシュ（キー: user_name）
+# （ユーザー情報を更新するAPIはないため、新形式のトークンはクレームをそのまま信頼し、キャッシュは使わない）
+principal_cache = TTLCache(
+    maxsize=int(os.getenv('PRINCIPAL_CACHE_MAXSIZE', '1024')),
+    ttl=float(os.getenv('PRINCIPAL_CACHE_TTL', '300'))
+)
 
-# パスワードのハッシュ化のための設定
-pwd_context = CryptContext(schemes=["argon2"], deprecated="auto")
+# 心拍数の履歴APIで1回に返す区間数の上限
+HEART_RATE_HISTORY_MAX_BUCKETS = int(os.getenv('HEART_RATE_HISTORY_MAX_BUCKETS', '2000'))
 
 # OAuth2の設定
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
 
 # ユーザーによってOuraAPIキーを変える関数
 def select_api_key(user):
+    settings = get_settings()
     if user.oura_id == 1:
-        return OURA_API_KEY_1
+        return settings.oura_api_key_1
     elif user.oura_id == 2:
-        return OURA_API_KEY_2
+        return settings.oura_api_key_2
     else:
         print(f"Invalid user type for user {user.user_name}")
         return None
 
-# パスワードの検証
-def verify_password(plain_password, hashed_password):
-    return pwd_context.verify(plain_password, hashed_password)
-
-# パスワードのハッシュ化
-def get_password_hash(password):
-    return pwd_context.hash(password)
-
 # アクセストークンの作成
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     to_encode = data.copy()
@@ -98,20 +135,29 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     return encoded_jwt
 
 # ユーザーを取得する関数
-def get_user(db: Session, username: str):
-    return db.query(User).filter(User.user_name == username).first()
+async def get_user(db: AsyncSession, username: str):
+    result = await db.execute(select(User).filter(User.user_name == username))
+    return result.scalars().first()
 
-# ユーザーの認証
-def authenticate_user(db: Session, username: str, password: str):
-    user = get_user(db, username)
+# ユーザーの認証（Argon2の検証は別プロセスで実行し、パラメータが変わっていれば再ハッシュして保存）
+async def authenticate_user(db: AsyncSession, username: str, password: str):
+    user = await get_user(db, username)
     if not user:
         return False
-    if not verify_password(password, user.password):
+    valid, new_hash = await password_hashing.verify_and_update_async(password, user.password)
+    if not valid:
         return False
+    if new_hash:
+        user.password = new_hash
+        await db.commit()
     return user
 
-# トークンのデコード
-def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)):
+# ユーザーからトークンに埋め込む認証情報を作成する関数
+def principal_from_user(user):
+    return Principal(user_id=user.user_id, user_name=user.user_name, oura_id=user.oura_id)
+
+# トークンのデコード（クレームから呼び出し元を特定し、DBへの問い合わせを行わない）
+async def get_current_user(token: str = Depends(oauth2_scheme), db: AsyncSession = Depends(get_db)):
     credentials_exception = HTTPException(
         status_code=HTTP_401_UNAUTHORIZED,
         detail="Could not validate credentials",
@@ -124,110 +170,170 @@ def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(
             raise credentials_exception
     except JWTError:
         raise credentials_exception
-    user = get_user(db, username=username)
+
+    # クレームに必要な情報が含まれていればそのまま利用
+    if payload.get("uid") is not None:
+        return Principal(user_id=payload["uid"], user_name=payload.get("name", username), oura_id=payload.get("oura_id"))
+
+    # user_idを含まない旧形式のトークンはDBから取得してキャッシュする
+    principal = principal_cache.get(username)
+    if principal is not None:
+        return principal
+    user = await get_user(db, username=username)
     if user is None:
         raise credentials_exception
-    return user
+    principal = principal_from_user(user)
+    principal_cache.set(username, principal)
+    return principal
 
 # coping_messageを取得する関数
-def fetch_coping_message(db: Session, user_id: int):
-    result = db.query(CopingMessage).filter(
+async def fetch_coping_message(db: AsyncSession, user_id: int):
+    start, end = day_range(datetime.today().strftime('%Y-%m-%d'))
+
+    # 最新の3つのメッセージのみを、必要なカラムだけ取得
+    result = await db.execute(select(
+        CopingMessage.coping_message_id,
+        CopingMessage.assistant_text,
+        CopingMessage.coping_message_text
+    ).filter(
         CopingMessage.user_id == user_id,
-        func.date(CopingMessage.create_datetime) == today_date
-    ).all()
-
-    # 最後の3つのメッセージのみを取得
-    last_three_messages = result[-3:]
-
-    return [message.__dict__ for message in last_three_messages]
-
-# daily_messageを取得する関数
-def fetch_daily_message(db: Session, user_id: int):
-    result = db.query(DailyMessage).filter(
+        CopingMessage.create_datetime >= start,
+        CopingMessage.create_datetime < end
+    ).order_by(
+        CopingMessage.create_datetime.desc(),
+        CopingMessage.coping_message_id.desc()
+    ).limit(3))
+
+    # 古い順に並べ直して返す
+    return list(reversed(result.all()))
+
+# 当日の最新のdaily_messageと、コンディションのスナップショットを1回のクエリで取得する関数
+async def fetch_condition(db: AsyncSession, user_id: int, oura_id: Optional[int], day: str):
+    start, end = day_range(day)
+    snapshot_filter = and_(ConditionSnapshot.oura_id == oura_id, ConditionSnapshot.day == day)
+    result = await db.execute(select(
+        DailyMessage.daily_message_text,
+        DailyMessage.previous_days_score,
+        DailyMessage.todays_days_score,
+        ConditionSnapshot
+    ).select_from(DailyMessage).outerjoin(ConditionSnapshot, snapshot_filter).filter(
         DailyMessage.user_id == user_id,
-        func.date(DailyMessage.create_datetime) == today_date
-    ).first()
-    return result
-
-def fetch_contributer(api_key: str):
-
-    url = 'https://api.ouraring.com/v2/usercollection/daily_readiness'
-    params = {
-        'start_date': today_date,
-        'end_date': today_date
-    }
-    headers = {
-        'Authorization': f'Bearer {api_key}'
-    }
-    response = requests.get(url, headers=headers, params=params)
-
-    if response.status_code != 200:
-        print(f"Failed to fetch data from API, status code: {response.status_code}")
+        DailyMessage.create_datetime >= start,
+        DailyMessage.create_datetime < end
+    ).order_by(
+        DailyMessage.create_datetime.desc(),
+        DailyMessage.daily_message_id.desc()
+    ).limit(1))
+    row = result.first()
+    if row is not None:
+        return row, row.ConditionSnapshot
+
+    # daily_messageがまだない場合はスナップショットのみ取得する
+    result = await db.execute(select(ConditionSnapshot).filter(snapshot_filter))
+    return None, result.scalars().first()
+
+# Ouraのdaily_readinessから当日のcontributerを取得する関数
+async def fetch_contributer(api_key: str):
+    day = datetime.today().strftime('%Y-%m-%d')
+    cache_key = (api_key, day)
+    cached = readiness_cache.get(cache_key)
+    if cached is not None:
+        return cached
+
+    data = await oura_client.fetch_daily_readiness(api_key, day, day)
+    if data is None:
         return None
 
-    data = response.json()
-
     if not data['data']:
         print("No data found for today")
         return None
 
-    print(data)
-
+    # データがある場合のみキャッシュする（未計測の日は後で再取得できるように）
+    readiness_cache.set(cache_key, data)
     return data
 
-# 最新の心拍数を取得する関数
-def fetch_heart_rate(api_key: int):
-    url = 'https://api.ouraring.com/v2/usercollection/heartrate'
-    params = {}
-    headers = {
-        'Authorization': f'Bearer {api_key}'
-    }
-    response = requests.request('GET', url, headers=headers, params=params)
-    data = response.json()
-    print(data)
-    latest_bpm = data['data'][-1]['bpm'] if 'data' in data and len(data['data']) > 0 else None
-    print(latest_bpm)
-    return(latest_bpm)
+# 実行中のスナップショット更新（キー: (oura_id, 日付), 値: 登録した時刻）
+# レスポンスの送信に失敗するとバックグラウンドタスクが実行されず削除されないため、一定時間を過ぎた登録は無効とみなす
+_refreshing_conditions = {}
+CONDITION_REFRESH_TIMEOUT = float(os.getenv('CONDITION_REFRESH_TIMEOUT', '60'))
+
+# Ouraから当日のdaily_readinessを取得し、スナップショットを更新する関数（レスポンス返却後に実行）
+async def refresh_condition_snapshot(oura_id: int, api_key: str, day: str, scheduled_at: float):
+    try:
+        data = await fetch_contributer(api_key)
+        if not data:
+            return
+        rows = [condition_snapshot.snapshot_row(oura_id, entry) for entry in data['data'] if entry.get('day') == day]
+        async with AsyncSessionLocal() as db:
+            await db.run_sync(condition_snapshot.save_snapshots, rows)
+    except Exception as e:
+        print(f"Failed to refresh condition snapshot for oura_id {oura_id}: {e!r}")
+    finally:
+        # 期限切れ後に別のリクエストが登録し直した場合は、その登録を残す
+        if _refreshing_conditions.get((oura_id, day)) == scheduled_at:
+            del _refreshing_conditions[(oura_id, day)]
+
+# スナップショットの更新をバックグラウンドタスクに登録する関数（同じ認証情報の更新は重複させない）
+def schedule_condition_refresh(background_tasks: BackgroundTasks, user, day: str):
+    api_key = select_api_key(user)
+    key = (user.oura_id, day)
+    now = time.monotonic()
+    scheduled_at = _refreshing_conditions.get(key)
+    if api_key is None or (scheduled_at is not None and now - scheduled_at < CONDITION_REFRESH_TIMEOUT):
+        return
+    _refreshing_conditions[key] = now
+    background_tasks.add_task(refresh_condition_snapshot, user.oura_id, api_key, day, now)
+
+# 取得した心拍数サンプルを保存する関数（レスポンス返却後に実行）
+async def store_heart_rate_samples(oura_id: int, samples):
+    try:
+        async with AsyncSessionLocal() as db:
+            await db.run_sync(heart_rate_store.save_samples, oura_id, samples)
+    except Exception as e:
+        print(f"Failed to store heart rate samples for oura_id {oura_id}: {e!r}")
+
+# 最新の心拍数を取得する関数（新しく取得したサンプルは応答後に心拍数の履歴に保存する）
+async def fetch_heart_rate(background_tasks: BackgroundTasks, user, api_key: str):
+    delta = await oura_client.fetch_heart_rate_delta(api_key)
+    if delta is None:
+        return None
+    samples, latest_bpm = delta
+    if samples and user.oura_id is not None:
+        background_tasks.add_task(store_heart_rate_samples, user.oura_id, samples)
+    return latest_bpm
 
 # 心拍数をheart_rate_beforeに登録する関数
-def update_heart_rate_before(db: Session, coping_message_id: int, heart_rate_before: int):
-    coping_message = db.query(CopingMessage).filter(CopingMessage.coping_message_id == coping_message_id).first()
+async def update_heart_rate_before(db: AsyncSession, coping_message_id: int, heart_rate_before: int):
+    result = await db.execute(select(CopingMessage).filter(CopingMessage.coping_message_id == coping_message_id))
+    coping_message = result.scalars().first()
     if coping_message:
         coping_message.heart_rate_before = heart_rate_before
-        db.commit()
-    else:
-        raise HTTPException(status_code=404, detail="Coping message not found")
-
-# 満足度を登録する関数
-def update_satisfaction_score(db: Session, coping_message_id: int, satisfaction_score: str):
-    coping_message = db.query(CopingMessage).filter(CopingMessage.coping_message_id == coping_message_id).first()
-    if coping_message:
-        coping_message.satisfaction_score = satisfaction_score
-        db.commit()
+        await db.commit()
     else:
         raise HTTPException(status_code=404, detail="Coping message not found")
 
-# 心拍数をheart_rate_afterに登録する関数
-def update_heart_rate_after(db: Session, coping_message_id: int, heart_rate_after: int):
-    coping_message = db.query(CopingMessage).filter(CopingMessage.coping_message_id == coping_message_id).first()
-    if coping_message:
-        coping_message.heart_rate_after = heart_rate_after
-        db.commit()
-    else:
+# コーピング完了時に満足度とheart_rate_afterを登録し、heart_rate_beforeを返す関数
+# （本人のcoping_messageであることを確認し、1回の取得と1トランザクションで完結させる）
+async def complete_coping_message(db: AsyncSession, coping_message_id: int, user_id: int, satisfaction_score: str, heart_rate_after: int):
+    result = await db.execute(select(CopingMessage).filter(
+        CopingMessage.coping_message_id == coping_message_id,
+        CopingMessage.user_id == user_id
+    ).with_for_update())
+    coping_message = result.scalars().first()
+    if not coping_message:
+        await db.rollback()
         raise HTTPException(status_code=404, detail="Coping message not found")
 
-# 特定のcoping_message_idのheart_rate_beforeを取得する関数
-def get_heart_rate_before(db: Session, coping_message_id: int):
-    coping_message = db.query(CopingMessage).filter(CopingMessage.coping_message_id == coping_message_id).first()
-    if coping_message:
-        return coping_message.heart_rate_before
-    else:
-        raise HTTPException(status_code=404, detail="Coping message not found")
+    heart_rate_before = coping_message.heart_rate_before
+    coping_message.satisfaction_score = satisfaction_score
+    coping_message.heart_rate_after = heart_rate_after
+    await db.commit()
+    return heart_rate_before
 
 # ログインAPI
 @app.post("/token", response_model=Token)
-async def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends(), db: Session = Depends(get_db)):
-    user = authenticate_user(db, form_data.username, form_data.password)
+async def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends(), db: AsyncSession = Depends(get_db)):
+    user = await authenticate_user(db, form_data.username, form_data.password)
     if not user:
         raise HTTPException(
             status_code=HTTP_401_UNAUTHORIZED,
@@ -236,17 +342,18 @@ async def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends(
         )
     access_token_expires = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
     access_token = create_access_token(
-        data={"sub": user.user_name}, expires_delta=access_token_expires
+        data={"sub": user.user_name, "uid": user.user_id, "oura_id": user.oura_id, "name": user.user_name},
+        expires_delta=access_token_expires
     )
     return {"access_token": access_token, "token_type": "bearer"}
 
 # ユーザーの登録API
 @app.post("/register")
-async def register_user(user: UserCreate, db: Session = Depends(get_db)):
+async def register_user(user: UserCreate, db: AsyncSession = Depends(get_db)):
     db_user = User(
         user_name=user.user_name,
         email=user.email,
-        password=get_password_hash(user.password),
+        password=await password_hashing.hash_password_async(user.password),
         type_id=0,  # 仮の値
         occupation_id="unknown",  # 仮の値
         overtime_id=0,  # 仮の値
@@ -254,49 +361,135 @@ async def register_user(user: UserCreate, db: Session = Depends(get_db)):
         update_datetime=datetime.now(pytz.timezone('Asia/Tokyo'))
     )
     db.add(db_user)
-    db.commit()
-    db.refresh(db_user)
+    await db.commit()
+    await db.refresh(db_user)
     return db_user
 
 
+# Prometheus形式のメトリクス取得API（プールサイズの調整に使うプール・キャッシュの状態は取得時に反映する）
+@app.get('/metrics', response_class=PlainTextResponse)
+async def get_metrics():
+    for name, stats in pool_stats().items():
+        metrics.export_stats('db_pool', stats, engine=name)
+    metrics.export_stats('cache', readiness_cache.stats(), cache='readiness')
+    metrics.export_stats('cache', principal_cache.stats(), cache='principal')
+    metrics.export_stats('oura_webhook', oura_webhook.stats())
+    return PlainTextResponse(metrics.render_prometheus(), media_type='text/plain; version=0.0.4; charset=utf-8')
+
+# Oura Webhookの登録時の検証API（verification_tokenが一致すればchallengeをそのまま返す）
+@app.get('/oura/webhook')
+async def verify_oura_webhook(verification_token: str, challenge: str):
+    expected = get_settings().oura_webhook_verification_token
+    if not expected or not hmac.compare_digest(verification_token, expected):
+        raise HTTPException(status_code=HTTP_401_UNAUTHORIZED, detail="Invalid verification token")
+    return {"challenge": challenge}
+
+# Oura Webhookの通知受信API（署名を検証し、変更されたドキュメントの取得をキューに登録する）
+@app.post('/oura/webhook', status_code=202)
+async def receive_oura_webhook(request: Request):
+    settings = get_settings()
+    body = await request.body()
+    if not oura_webhook.verify_signature(
+        settings.oura_webhook_secret,
+        request.headers.get('x-oura-timestamp'),
+        body,
+        request.headers.get('x-oura-signature')
+    ):
+        raise HTTPException(status_code=HTTP_401_UNAUTHORIZED, detail="Invalid signature")
+
+    try:
+        event = json.loads(body)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid JSON")
+    if not isinstance(event, dict):
+        raise HTTPException(status_code=400, detail="Invalid notification")
+
+    credential = oura_webhook.resolve_credential(settings, event.get('user_id'))
+    if credential is None:
+        # 登録されていないユーザーの通知は再送されないよう受け付けたうえで破棄する
+        return {"status": "unknown_user"}
+    oura_id, api_key = credential
+    status = oura_webhook.enqueue(event, oura_id, api_key)
+    # キューに登録できなかった通知はOuraに再送させる（2xxを返すと配信済みとして扱われ、変更が失われる）
+    if status in ("queue_full", "not_running"):
+        raise HTTPException(status_code=503, detail=f"Webhook {status}", headers={"Retry-After": "60"})
+    return {"status": status}
+
 # レコメンドページ情報取得API
-@app.get('/coping_message')
-async def get_coping_message(current_user: User = Depends(get_current_user), db: Session = Depends(get_db)):
-    messages = fetch_coping_message(db, current_user.user_id)
-    return {
-        "user_name": current_user.user_name,
-        "assistant_text": messages[0]["assistant_text"],
-        "coping_messages": [{"coping_message_id": message["coping_message_id"],
-                            "coping_message_text": message["coping_message_text"]
-                            } for message in messages]
-    }
+@app.get('/coping_message', response_model=CopingMessageResponse)
+async def get_coping_message(current_user: Principal = Depends(get_current_user), db: AsyncSession = Depends(get_read_db)):
+    messages = await fetch_coping_message(db, current_user.user_id)
+    if not messages:
+        raise HTTPException(status_code=404, detail="Coping message not found")
+    return CopingMessageResponse(
+        user_name=current_user.user_name,
+        assistant_text=messages[0].assistant_text,
+        coping_messages=[
+            CopingMessageItem(
+                coping_message_id=message.coping_message_id,
+                coping_message_text=message.coping_message_text
+            ) for message in messages
+        ]
+    )
 
 # コンディションページ情報取得API
+# （Ouraには問い合わせず、バッチ・Webhookが保存したスナップショットを返す。スナップショットがない・古い場合は応答後に更新する）
 @app.get('/condition')
-async def get_condition_info(current_user: User = Depends(get_current_user), db: Session = Depends(get_db)):
-    message = fetch_daily_message(db, current_user.user_id) # daily_messageを取得
-    api_key = select_api_key(current_user) # OuraのAPIキーを取得
-    contributer = fetch_contributer(api_key) # Ouraのスコアを取得
-    contributer_data = contributer['data'][0] if contributer['data'] else {} # Ouraスコアの中でcontributerデータを抽出
+async def get_condition_info(background_tasks: BackgroundTasks, current_user: Principal = Depends(get_current_user), db: AsyncSession = Depends(get_read_db)):
+    day = datetime.today().strftime('%Y-%m-%d')
+    message, snapshot = await fetch_condition(db, current_user.user_id, current_user.oura_id, day)
+    # Webhookが有効な場合は変更時に更新されるため、スナップショットがないときだけ取得する
+    webhook_enabled = get_settings().oura_webhook_enabled
+    if snapshot is None or (not webhook_enabled and condition_snapshot.is_stale(snapshot)):
+        schedule_condition_refresh(background_tasks, current_user, day)
     return {
         "user_name": current_user.user_name,
-        "daily_message_text": message.daily_message_text,
-        "previous_days_score": message.previous_days_score,
-        "todays_days_score": message.todays_days_score,
-        "activity_balance": contributer_data.get('contributors', {}).get('activity_balance'),
-        "body_temperature": contributer_data.get('contributors', {}).get('body_temperature'),
-        "hrv_balance": contributer_data.get('contributors', {}).get('hrv_balance'),
-        "previous_day_activity": contributer_data.get('contributors', {}).get('previous_day_activity'),
-        "previous_night": contributer_data.get('contributors', {}).get('previous_night'),
-        "recovery_index": contributer_data.get('contributors', {}).get('recovery_index'),
-        "resting_heart_rate": contributer_data.get('contributors', {}).get('resting_heart_rate'),
-        "sleep_balance": contributer_data.get('contributors', {}).get('sleep_balance'),
-        "day": contributer_data.get('day')
+        "daily_message_text": getattr(message, 'daily_message_text', None),
+        "previous_days_score": getattr(message, 'previous_days_score', None),
+        "todays_days_score": getattr(message, 'todays_days_score', None),
+        **{name: getattr(snapshot, name, None) for name in condition_snapshot.CONTRIBUTOR_NAMES},
+        "day": getattr(snapshot, 'day', None)
     }
 
+# タイムゾーンのない日時は日本時間とみなしてUTCに変換する関数
+def as_utc(value: datetime):
+    if value.tzinfo is None:
+        value = pytz.timezone('Asia/Tokyo').localize(value)
+    return value.astimezone(timezone.utc)
+
+# 心拍数の履歴取得API（保存済みのサンプルをresolution秒ごとに集計し、最小・平均・最大を返す）
+# start・endを省略した場合は直近24時間を返す
+@app.get('/heart_rate/history', response_model=HeartRateHistoryResponse)
+async def get_heart_rate_history(
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+    resolution: int = 3600,
+    current_user: Principal = Depends(get_current_user),
+    db: AsyncSession = Depends(get_read_db)
+):
+    end = as_utc(end) if end else datetime.now(timezone.utc)
+    start = as_utc(start) if start else end - timedelta(days=1)
+    if resolution < 5:
+        raise HTTPException(status_code=400, detail="resolutionは5秒以上を指定してください")
+    if end <= start:
+        raise HTTPException(status_code=400, detail="endはstartより後の日時を指定してください")
+    if (end - start).total_seconds() / resolution > HEART_RATE_HISTORY_MAX_BUCKETS:
+        raise HTTPException(status_code=400, detail=f"区間数が上限（{HEART_RATE_HISTORY_MAX_BUCKETS}）を超えています")
+    if current_user.oura_id is None:
+        raise HTTPException(status_code=404, detail='心拍数が見つかりません')
+
+    buckets = await db.run_sync(heart_rate_store.bucket_history, current_user.oura_id, start, end, resolution)
+    return HeartRateHistoryResponse(
+        user_name=current_user.user_name,
+        start=start,
+        end=end,
+        resolution=resolution,
+        buckets=buckets
+    )
+
 # コーピング実施前の心拍数取得API。coping_message_idをリクエストに含める必要あり
 @app.post('/coping_start')
-async def coping_start(request: Request, current_user: User = Depends(get_current_user), db: Session = Depends(get_db)):
+async def coping_start(request: Request, background_tasks: BackgroundTasks, current_user: Principal = Depends(get_current_user), db: AsyncSession = Depends(get_db)):
     # リクエストからcoping_message_idを取得
     data = await request.json()
     coping_message_id = data.get('coping_message_id')
@@ -305,12 +498,12 @@ async def coping_start(request: Request, current_user: User = Depends(get_curren
     
     # 心拍数取得
     api_key = select_api_key(current_user) # OuraのAPIキーを取得
-    latest_heart_rate = fetch_heart_rate(api_key)
+    latest_heart_rate = await fetch_heart_rate(background_tasks, current_user, api_key)
     if latest_heart_rate is None:
         raise HTTPException(status_code=404, detail='心拍数が見つかりません')
     
     # 心拍数をcoping_messageに登録
-    update_heart_rate_before(db, coping_message_id, latest_heart_rate)
+    await update_heart_rate_before(db, coping_message_id, latest_heart_rate)
     return{
             "message": "心拍数を登録しました",
             "heart_rate_before": latest_heart_rate
@@ -318,7 +511,7 @@ async def coping_start(request: Request, current_user: User = Depends(get_curren
 
 #コーピング実施後の満足度登録/心拍数取得/メッセージ表示API。coping_message_id、satisfaction_scoreをリクエストに含める必要あり
 @app.post('/coping_finish')
-async def coping_finish(request: Request, current_user: User = Depends(get_current_user), db: Session = Depends(get_db)):
+async def coping_finish(request: Request, background_tasks: BackgroundTasks, current_user: Principal = Depends(get_current_user), db: AsyncSession = Depends(get_db)):
     # リクエストからcoping_message_idを取得
     data = await request.json()
     coping_message_id = data.get('coping_message_id')
@@ -332,18 +525,14 @@ async def coping_finish(request: Request, current_user: User = Depends(get_curre
 
     # 心拍数取得
     api_key = select_api_key(current_user) # OuraのAPIキーを取得
-    latest_heart_rate = fetch_heart_rate(api_key)
+    latest_heart_rate = await fetch_heart_rate(background_tasks, current_user, api_key)
     if latest_heart_rate is None:
         raise HTTPException(status_code=404, detail='心拍数が見つかりません')
     
-    # satisfaction_scoreを登録
-    update_satisfaction_score(db, coping_message_id, satisfaction_score)
-    
-    # 心拍数を登録
-    update_heart_rate_after(db, coping_message_id, latest_heart_rate)
-
-    # heart_rate_beforeをテーブルから取得
-    heart_rate_before = get_heart_rate_before(db, coping_message_id)
+    # satisfaction_scoreと心拍数を登録し、heart_rate_beforeを取得
+    heart_rate_before = await complete_coping_message(
+        db, coping_message_id, current_user.user_id, satisfaction_score, latest_heart_rate
+    )
 
     # heart_rate_beforeとheart_rate_afterを比較して、メッセージを作成
     if latest_heart_rate < heart_rate_before:
@@ -0,0 +1,209 @@
+import json
+import math
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from threading import Lock
+
+# レイテンシ用のヒストグラムの既定のバケット（秒）
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+# 登録済みのメトリクス（名前: メトリクス）
+_registry = {}
+_registry_lock = Lock()
+
+# リクエスト単位のDBクエリ数・時間（ミドルウェアがリクエストごとに設定する）
+request_db_stats = ContextVar('request_db_stats', default=None)
+
+# ラベルをPrometheusの形式に変換する関数
+def _format_labels(labels):
+    if not labels:
+        return ''
+    escaped = [
+        '{}="{}"'.format(key, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for key, value in labels
+    ]
+    return '{' + ','.join(escaped) + '}'
+
+# 数値をPrometheusの形式に変換する関数
+def _format_value(value):
+    if value == math.inf:
+        return '+Inf'
+    return repr(float(value))
+
+# メトリクスの基底クラス
+class _Metric:
+    type_name = 'untyped'
+
+    def __init__(self, name: str, help_text: str):
+        self.name = name
+        self.help_text = help_text
+        self._values = {}
+        self._lock = Lock()
+
+    def _key(self, labels):
+        return tuple(sorted(labels.items()))
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} {self.type_name}"]
+        with self._lock:
+            for labels, value in self._values.items():
+                lines.append(f"{self.name}{_format_labels(labels)} {_format_value(value)}")
+        return lines
+
+    def snapshot(self):
+        with self._lock:
+            return [{"labels": dict(labels), "value": value} for labels, value in self._values.items()]
+
+# 増加のみするカウンター
+class Counter(_Metric):
+    type_name = 'counter'
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+# 任意の値を設定できるゲージ
+class Gauge(_Metric):
+    type_name = 'gauge'
+
+    def set(self, value: float, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+# 分布を記録するヒストグラム
+class Histogram(_Metric):
+    type_name = 'histogram'
+
+    def __init__(self, name: str, help_text: str, buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help_text)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = {"buckets": [0] * len(self.buckets), "sum": 0.0, "count": 0, "max": 0.0}
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state["buckets"][i] += 1
+                    break
+            state["sum"] += value
+            state["count"] += 1
+            state["max"] = max(state["max"], value)
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} {self.type_name}"]
+        with self._lock:
+            for labels, state in self._values.items():
+                cumulative = 0
+                for bound, count in zip(self.buckets, state["buckets"]):
+                    cumulative += count
+                    bucket_labels = labels + (('le', _format_value(bound)),)
+                    lines.append(f"{self.name}_bucket{_format_labels(bucket_labels)} {cumulative}")
+                lines.append(f"{self.name}_sum{_format_labels(labels)} {_format_value(state['sum'])}")
+                lines.append(f"{self.name}_count{_format_labels(labels)} {state['count']}")
+        return lines
+
+    def snapshot(self):
+        with self._lock:
+            return [
+                {
+                    "labels": dict(labels),
+                    "count": state["count"],
+                    "sum": state["sum"],
+                    "mean": state["sum"] / state["count"] if state["count"] else 0.0,
+                    "max": state["max"]
+                }
+                for labels, state in self._values.items()
+            ]
+
+# 同じ名前のメトリクスは1つだけ作る関数
+def _get_or_create(cls, name, help_text, **kwargs):
+    with _registry_lock:
+        metric = _registry.get(name)
+        if metric is None:
+            metric = _registry[name] = cls(name, help_text, **kwargs)
+        return metric
+
+def counter(name: str, help_text: str):
+    return _get_or_create(Counter, name, help_text)
+
+def gauge(name: str, help_text: str):
+    return _get_or_create(Gauge, name, help_text)
+
+def histogram(name: str, help_text: str, buckets=DEFAULT_BUCKETS):
+    return _get_or_create(Histogram, name, help_text, buckets=buckets)
+
+# アプリ全体で使うメトリクス
+http_request_duration = histogram(
+    'http_request_duration_seconds', 'HTTP request latency by route')
+upstream_request_duration = histogram(
+    'upstream_request_duration_seconds', 'Latency of calls to external APIs by service, endpoint and status')
+db_query_duration = histogram(
+    'db_query_duration_seconds', 'Latency of individual SQL statements by engine')
+db_queries_per_request = histogram(
+    'db_queries_per_request', 'Number of SQL statements per HTTP request by route', buckets=(0, 1, 2, 3, 5, 10, 20, 50))
+db_time_per_request = histogram(
+    'db_time_per_request_seconds', 'Total SQL time per HTTP request by route')
+batch_stage_duration = histogram(
+    'batch_stage_duration_seconds', 'Duration of daily batch stages')
+
+# Prometheusのテキスト形式で全メトリクスを出力する関数
+def render_prometheus():
+    with _registry_lock:
+        metrics = list(_registry.values())
+    lines = []
+    for metric in metrics:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+# 統計値の辞書（プールやキャッシュのstats()）をゲージとして反映する関数
+def export_stats(prefix: str, stats: dict, **labels):
+    for key, value in stats.items():
+        if isinstance(value, (int, float)) and not isinstance(value, bool):
+            gauge(f"{prefix}_{key}", f"{prefix} {key}".replace('_', ' ')).set(value, **labels)
+
+# 全メトリクスを辞書形式で返す関数（バッチの実行サマリー用）
+def snapshot():
+    with _registry_lock:
+        metrics = list(_registry.values())
+    return {metric.name: metric.snapshot() for metric in metrics}
+
+# 全メトリクスをJSONファイルに書き出す関数
+def write_json(path: str, extra: dict = None):
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump({**(extra or {}), "metrics": snapshot()}, f, ensure_ascii=False, indent=2, default=str)
+
+# リクエスト単位のDB統計の記録を開始する関数（戻り値の辞書にクエリ数と時間が加算される）
+def start_request_db_stats():
+    stats = {"queries": 0, "seconds": 0.0}
+    token = request_db_stats.set(stats)
+    return stats, token
+
+# SQLAlchemyのエンジンにクエリ時間を計測するイベントを登録する関数
+def instrument_engine(engine, name: str):
+    from sqlalchemy import event
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('query_start_time', []).append(time.perf_counter())
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - conn.info['query_start_time'].pop()
+        db_query_duration.observe(elapsed, engine=name)
+        stats = request_db_stats.get()
+        if stats is not None:
+            stats["queries"] += 1
+            stats["seconds"] += elapsed
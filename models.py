@@ -1,13 +1,18 @@
-from sqlalchemy import Column, Integer, String, Text, DateTime, ForeignKey
+from sqlalchemy import Column, Integer, BigInteger, String, Text, DateTime, ForeignKey, Index, UniqueConstraint, LargeBinary
 from sqlalchemy.orm import relationship
 from db.db_config import Base
-from datetime import datetime
+from datetime import datetime, timedelta
 import pytz
 
 # 日本時間取得
 def jst_now():
     return datetime.now(pytz.timezone('Asia/Tokyo'))
 
+# 指定日（YYYY-MM-DD）の0時から翌日0時までの範囲を返す関数（インデックスが効く範囲検索に使う）
+def day_range(day: str):
+    start = datetime.strptime(day, '%Y-%m-%d')
+    return start, start + timedelta(days=1)
+
 # テーブルの定義
 class User(Base):
     __tablename__ = "users"
@@ -29,6 +34,9 @@ class User(Base):
 
 class CopingMessage(Base):
     __tablename__ = "coping_messages"
+    __table_args__ = (
+        Index("ix_coping_messages_user_id_create_datetime", "user_id", "create_datetime"),
+    )
 
     coping_message_id = Column(Integer, primary_key=True, index=True, autoincrement=True)
     user_id = Column(Integer, ForeignKey('users.user_id'), nullable=False)
@@ -59,6 +67,9 @@ class CopingMaster(Base):
 
 class DailyMessage(Base):
     __tablename__ = "daily_messages"
+    __table_args__ = (
+        Index("ix_daily_messages_user_id_create_datetime", "user_id", "create_datetime"),
+    )
 
     daily_message_id = Column(Integer, primary_key=True, index=True, autoincrement=True)
     user_id = Column(Integer, ForeignKey('users.user_id'), nullable=False)
@@ -69,4 +80,66 @@ class DailyMessage(Base):
     update_datetime = Column(DateTime, default=jst_now, onupdate=jst_now)
 
     # リレーションシップの定義
-    user = relationship("User", back_populates="daily_messages")
\ No newline at end of file
+    user = relationship("User", back_populates="daily_messages")
+
+class AdviceCache(Base):
+    __tablename__ = "advice_cache"
+
+    advice_cache_id = Column(Integer, primary_key=True, index=True, autoincrement=True)
+    cache_key = Column(String(64), nullable=False, index=True)  # プロンプトとモデル名のSHA-256
+    model = Column(String(225), nullable=False)
+    advice_text = Column(Text, nullable=False)
+    create_datetime = Column(DateTime, default=jst_now)
+
+# Ouraのdaily_readinessのスナップショット（認証情報(oura_id)・日付ごとに1行）
+# バッチ・/conditionのバックグラウンド更新で保存し、/conditionはここから読み込む
+class ConditionSnapshot(Base):
+    __tablename__ = "condition_snapshots"
+    __table_args__ = (
+        UniqueConstraint("oura_id", "day", name="uq_condition_snapshots_oura_id_day"),
+    )
+
+    condition_snapshot_id = Column(Integer, primary_key=True, index=True, autoincrement=True)
+    oura_id = Column(Integer, nullable=False)
+    day = Column(String(10), nullable=False)  # YYYY-MM-DD
+    score = Column(Integer)
+    activity_balance = Column(Integer)
+    body_temperature = Column(Integer)
+    hrv_balance = Column(Integer)
+    previous_day_activity = Column(Integer)
+    previous_night = Column(Integer)
+    recovery_index = Column(Integer)
+    resting_heart_rate = Column(Integer)
+    sleep_balance = Column(Integer)
+    create_datetime = Column(DateTime, default=jst_now)
+    update_datetime = Column(DateTime, default=jst_now, onupdate=jst_now)
+
+# Ouraの心拍数サンプル（認証情報(oura_id)・UTCの日付ごとに1行）
+# サンプルは配列としてまとめて保存する（offsets: 日付の0時からの秒数(int32)、bpms: 心拍数(uint8)、時刻順）
+class HeartRateDay(Base):
+    __tablename__ = "heart_rate_days"
+    __table_args__ = (
+        UniqueConstraint("oura_id", "day", name="uq_heart_rate_days_oura_id_day"),
+    )
+
+    heart_rate_day_id = Column(Integer, primary_key=True, index=True, autoincrement=True)
+    oura_id = Column(Integer, nullable=False)
+    day = Column(String(10), nullable=False)  # YYYY-MM-DD（UTC）
+    sample_count = Column(Integer, nullable=False, default=0)
+    last_timestamp = Column(BigInteger)  # 最後のサンプルのUNIX時間（秒）
+    offsets = Column(LargeBinary(length=2 ** 24 - 1), nullable=False)
+    bpms = Column(LargeBinary(length=2 ** 24 - 1), nullable=False)
+    create_datetime = Column(DateTime, default=jst_now)
+    update_datetime = Column(DateTime, default=jst_now, onupdate=jst_now)
+
+# バッチの入力（日付・スコア・score_id・時間枠・コーピングマスタのバージョン）のフィンガープリント
+# ユーザーごとに1行持ち、前回の実行と入力が同じユーザーはメッセージを作り直さない
+class BatchFingerprint(Base):
+    __tablename__ = "batch_fingerprints"
+
+    batch_fingerprint_id = Column(Integer, primary_key=True, index=True, autoincrement=True)
+    user_id = Column(Integer, ForeignKey('users.user_id'), nullable=False, unique=True)
+    day = Column(String(10), nullable=False)  # YYYY-MM-DD
+    fingerprint = Column(String(64), nullable=False)  # 入力のSHA-256
+    create_datetime = Column(DateTime, default=jst_now)
+    update_datetime = Column(DateTime, default=jst_now, onupdate=jst_now)
@@ -0,0 +1,149 @@
+import os
+import time
+import httpx
+from datetime import datetime, timedelta, timezone
+import metrics
+
+# 共有の非同期HTTPクライアント（プロセス内で1つだけ生成する）
+_client = None
+
+# APIキーごとに最後に取得した心拍数サンプル（キー: APIキー, 値: (timestamp, bpm)）
+_last_heart_rate = {}
+
+# HTTP/2が利用可能か判定する関数（h2パッケージがある場合のみ有効）
+def _http2_available():
+    try:
+        import h2  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+# OuraAPI用の共有クライアントを取得する関数
+def get_client():
+    global _client
+    if _client is None or _client.is_closed:
+        # 設定は.env読み込み後に参照できるよう、生成時に環境変数から取得する
+        base_url = os.getenv('OURA_API_BASE_URL', 'https://api.ouraring.com')
+        timeout = httpx.Timeout(
+            float(os.getenv('OURA_READ_TIMEOUT', '10')),
+            connect=float(os.getenv('OURA_CONNECT_TIMEOUT', '3'))
+        )
+        limits = httpx.Limits(
+            max_connections=int(os.getenv('OURA_MAX_CONNECTIONS', '20')),
+            max_keepalive_connections=int(os.getenv('OURA_MAX_KEEPALIVE_CONNECTIONS', '10'))
+        )
+        _client = httpx.AsyncClient(
+            base_url=base_url,
+            timeout=timeout,
+            limits=limits,
+            http2=_http2_available()
+        )
+    return _client
+
+# 共有クライアントを閉じる関数（アプリ終了時・バッチ終了時に呼ぶ）
+async def close_client():
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+
+# OuraAPIにGETリクエストを送り、JSONを返す関数。失敗時はNoneを返す
+# （endpointはメトリクスのラベルに使うパス。IDを含むパスはテンプレートを渡す）
+async def _get(path: str, api_key: str, params: dict, timeout=None, endpoint: str = None):
+    headers = {
+        'Authorization': f'Bearer {api_key}'
+    }
+    kwargs = {'headers': headers, 'params': params}
+    if timeout is not None:
+        kwargs['timeout'] = timeout
+    start = time.perf_counter()
+    try:
+        response = await get_client().get(path, **kwargs)
+    except httpx.HTTPError as e:
+        metrics.upstream_request_duration.observe(
+            time.perf_counter() - start, service='oura', endpoint=endpoint or path, status=e.__class__.__name__)
+        print(f"Failed to fetch data from API ({path}): {e!r}")
+        return None
+    metrics.upstream_request_duration.observe(
+        time.perf_counter() - start, service='oura', endpoint=endpoint or path, status=str(response.status_code))
+
+    if response.status_code != 200:
+        print(f"Failed to fetch data from API ({path}), status code: {response.status_code}")
+        return None
+
+    return response.json()
+
+# 指定期間のdaily_readinessを取得する関数
+async def fetch_daily_readiness(api_key: str, start_date: str, end_date: str, timeout=None):
+    params = {
+        'start_date': start_date,
+        'end_date': end_date
+    }
+    return await _get('/v2/usercollection/daily_readiness', api_key, params, timeout)
+
+# IDを指定してdaily_readinessを1件取得する関数（Webhookで通知されたドキュメントの取得用）
+async def fetch_daily_readiness_document(api_key: str, document_id: str, timeout=None):
+    return await _get(
+        f'/v2/usercollection/daily_readiness/{document_id}', api_key, {}, timeout,
+        endpoint='/v2/usercollection/daily_readiness/{document_id}'
+    )
+
+# 心拍数を取得する関数
+async def fetch_heart_rate(api_key: str, params: dict = None, timeout=None):
+    return await _get('/v2/usercollection/heartrate', api_key, params or {}, timeout)
+
+# Ouraのtimestamp文字列をUTCのdatetimeに変換する関数
+def _parse_timestamp(value: str):
+    return datetime.fromisoformat(value.replace('Z', '+00:00')).astimezone(timezone.utc)
+
+# 指定期間の心拍数をすべて取得する関数（next_tokenを辿ってページをまとめる）。失敗時はNoneを返す
+async def fetch_heart_rate_range(api_key: str, start: datetime, end: datetime, timeout=None):
+    params = {
+        'start_datetime': start.isoformat(timespec='seconds'),
+        'end_datetime': end.isoformat(timespec='seconds')
+    }
+    samples = []
+    while True:
+        data = await fetch_heart_rate(api_key, params, timeout)
+        if data is None:
+            return None
+        samples.extend(data.get('data') or [])
+        if not data.get('next_token'):
+            return samples
+        params = {**params, 'next_token': data['next_token']}
+
+# 直近の時間窓のうち、前回取得以降の差分だけを取得する関数
+# （新しく取得したサンプルと最新の心拍数を返す。取得に失敗した場合はNoneを返す）
+async def fetch_heart_rate_delta(api_key: str, timeout=None):
+    now = datetime.now(timezone.utc)
+    window_start = now - timedelta(minutes=float(os.getenv('HEART_RATE_WINDOW_MINUTES', '60')))
+
+    # 前回のサンプルが時間窓内にあれば、その次の秒から先だけを取得する（前回のサンプルは取得し直さない）
+    last = _last_heart_rate.get(api_key)
+    start = last[0] + timedelta(seconds=1) if last and last[0] > window_start else window_start
+    params = {
+        'start_datetime': start.isoformat(timespec='seconds'),
+        'end_datetime': now.isoformat(timespec='seconds')
+    }
+    data = await fetch_heart_rate(api_key, params, timeout)
+    if data is None:
+        return None
+    samples = data.get('data') or []
+
+    # リングが時間窓内に同期されていない場合は、期間を指定せずに取得し（OuraAPIの既定の期間）、その最新値を使う
+    if not samples and (last is None or last[0] < window_start):
+        data = await fetch_heart_rate(api_key, {}, timeout)
+        if data is None:
+            return None
+        samples = data.get('data') or []
+
+    if samples:
+        latest = samples[-1]
+        timestamp = _parse_timestamp(latest['timestamp'])
+        if last is None or timestamp >= last[0]:
+            last = (timestamp, latest['bpm'])
+            _last_heart_rate[api_key] = last
+
+    if last is None:
+        return samples, None
+    return samples, last[1]
@@ -0,0 +1,130 @@
+import asyncio
+import hashlib
+import hmac
+import os
+import time
+import metrics
+import oura_client
+import condition_snapshot
+from db.db_config import AsyncSessionLocal
+
+# Oura Webhookの通知を受け取り、変更されたドキュメントだけを取得してローカルのテーブルに保存する
+# （Webhookで通知されるのはdaily_readinessなどの日次データのみで、heartrateは通知対象外）
+
+# 署名のタイムスタンプの許容誤差（秒）
+OURA_WEBHOOK_TOLERANCE = float(os.getenv('OURA_WEBHOOK_TOLERANCE', '300'))
+
+# 取得待ちの通知の上限と、取得を行うワーカー数
+OURA_WEBHOOK_QUEUE_SIZE = int(os.getenv('OURA_WEBHOOK_QUEUE_SIZE', '1000'))
+OURA_WEBHOOK_WORKERS = int(os.getenv('OURA_WEBHOOK_WORKERS', '2'))
+
+# 通知の処理結果のカウンター
+webhook_events = metrics.counter(
+    'oura_webhook_events_total', 'Oura webhook notifications by data type, event type and result')
+
+# 取得待ちのキュー・キューにある通知のキー・ワーカー（start_workersで作成する）
+_queue = None
+_pending = set()
+_workers = []
+
+# 通知本文とタイムスタンプから署名を計算する関数
+def compute_signature(secret: str, timestamp: str, body: bytes):
+    return hmac.new(secret.encode(), timestamp.encode() + body, hashlib.sha256).hexdigest().upper()
+
+# 通知の署名とタイムスタンプを検証する関数
+def verify_signature(secret: str, timestamp: str, body: bytes, signature: str, tolerance: float = OURA_WEBHOOK_TOLERANCE):
+    if not secret or not timestamp or not signature:
+        return False
+    try:
+        sent_at = float(timestamp)
+    except ValueError:
+        return False
+    # 古い通知の再送（リプレイ）を受け付けない
+    if abs(time.time() - sent_at) > tolerance:
+        return False
+    return hmac.compare_digest(compute_signature(secret, timestamp, body), signature.upper())
+
+# 通知のuser_idから、対応するoura_idとAPIキーを返す関数（設定にないユーザーはNone）
+def resolve_credential(settings, oura_user_id: str):
+    if oura_user_id and oura_user_id == settings.oura_user_id_1:
+        return 1, settings.oura_api_key_1
+    if oura_user_id and oura_user_id == settings.oura_user_id_2:
+        return 2, settings.oura_api_key_2
+    return None
+
+# daily_readinessのドキュメントを取得し、コンディションのスナップショットに保存する関数
+async def _store_daily_readiness(event: dict, oura_id: int, api_key: str):
+    document = await oura_client.fetch_daily_readiness_document(api_key, event['object_id'])
+    if document is None:
+        return "fetch_failed"
+    async with AsyncSessionLocal() as db:
+        await db.run_sync(condition_snapshot.save_snapshots, [condition_snapshot.snapshot_row(oura_id, document)])
+    return "stored"
+
+# データ種別ごとの取り込み処理
+HANDLERS = {
+    'daily_readiness': _store_daily_readiness,
+}
+
+# 通知を取得待ちのキューに追加する関数。追加しなかった場合は理由を返す（"queue_full"/"not_running"は再送が必要）
+def enqueue(event: dict, oura_id: int, api_key: str):
+    data_type = event.get('data_type')
+    event_type = event.get('event_type')
+    if data_type not in HANDLERS or event_type not in ('create', 'update') or not event.get('object_id'):
+        webhook_events.inc(data_type=str(data_type), event_type=str(event_type), result='ignored')
+        return "ignored"
+    if _queue is None:
+        webhook_events.inc(data_type=data_type, event_type=event_type, result='not_running')
+        return "not_running"
+
+    # 取得前に同じドキュメントの通知が重なった場合は1回だけ取得する
+    key = (data_type, event['object_id'], oura_id)
+    if key in _pending:
+        webhook_events.inc(data_type=data_type, event_type=event_type, result='duplicate')
+        return "duplicate"
+    try:
+        _queue.put_nowait((key, event, oura_id, api_key))
+    except asyncio.QueueFull:
+        webhook_events.inc(data_type=data_type, event_type=event_type, result='queue_full')
+        return "queue_full"
+    _pending.add(key)
+    return "queued"
+
+# キューから通知を取り出してドキュメントを取得するワーカー
+async def _worker():
+    while True:
+        key, event, oura_id, api_key = await _queue.get()
+        # 取得中に届いた更新は再度キューに入るよう、取得前にキーを外す
+        _pending.discard(key)
+        try:
+            result = await HANDLERS[event['data_type']](event, oura_id, api_key)
+        except Exception as e:
+            print(f"Failed to process Oura webhook {event.get('data_type')}/{event.get('object_id')}: {e!r}")
+            result = "error"
+        finally:
+            _queue.task_done()
+        webhook_events.inc(data_type=event['data_type'], event_type=event['event_type'], result=result)
+
+# ワーカーを起動する関数（アプリ起動時に呼ぶ）
+def start_workers(workers: int = OURA_WEBHOOK_WORKERS):
+    global _queue
+    if _queue is None:
+        _queue = asyncio.Queue(maxsize=OURA_WEBHOOK_QUEUE_SIZE)
+        _workers.extend(asyncio.create_task(_worker()) for _ in range(max(1, workers)))
+
+# ワーカーを停止する関数（アプリ終了時に呼ぶ。取得待ちの通知は破棄する）
+async def stop_workers():
+    global _queue
+    for task in _workers:
+        task.cancel()
+    await asyncio.gather(*_workers, return_exceptions=True)
+    _workers.clear()
+    _pending.clear()
+    _queue = None
+
+# キューの状態を返す関数
+def stats():
+    return {
+        "queued": _queue.qsize() if _queue is not None else 0,
+        "workers": len(_workers)
+    }
@@ -0,0 +1,76 @@
+import asyncio
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from dotenv import load_dotenv
+from passlib.context import CryptContext
+
+# .envファイルから環境変数を読み込む（ワーカープロセスでも同じ設定を使うため）
+load_dotenv()
+
+# 環境変数で指定されたArgon2のコストパラメータだけを設定する関数
+# （未指定の場合はpasslibの既定値を使い、既存のハッシュをそのまま有効にする）
+def _argon2_settings():
+    settings = {}
+    for env_name, key in [
+        ('ARGON2_TIME_COST', 'argon2__rounds'),
+        ('ARGON2_MEMORY_COST', 'argon2__memory_cost'),
+        ('ARGON2_PARALLELISM', 'argon2__parallelism'),
+    ]:
+        value = os.getenv(env_name)
+        if value:
+            settings[key] = int(value)
+    return settings
+
+# パスワードのハッシュ化のための設定（パラメータが変わったハッシュはneeds_update扱いになる）
+pwd_context = CryptContext(schemes=["argon2"], deprecated="auto", **_argon2_settings())
+
+# ハッシュ計算用のプロセス数と、同時に受け付ける処理数の上限
+PASSWORD_HASH_WORKERS = int(os.getenv('PASSWORD_HASH_WORKERS', str(min(4, os.cpu_count() or 1))))
+PASSWORD_HASH_MAX_PENDING = int(os.getenv('PASSWORD_HASH_MAX_PENDING', str(PASSWORD_HASH_WORKERS * 4)))
+
+_executor = None
+_semaphore = None
+
+# パスワードのハッシュ化
+def hash_password(password: str):
+    return pwd_context.hash(password)
+
+# パスワードの検証。パラメータ変更などで再ハッシュが必要な場合は新しいハッシュも返す
+def verify_and_update(password: str, hashed_password: str):
+    return pwd_context.verify_and_update(password, hashed_password)
+
+# ハッシュ計算用のプロセスプールを取得する関数
+def _get_executor():
+    global _executor
+    if _executor is None:
+        _executor = ProcessPoolExecutor(
+            max_workers=max(1, PASSWORD_HASH_WORKERS),
+            mp_context=multiprocessing.get_context('spawn')
+        )
+    return _executor
+
+# プロセスプールで関数を実行する関数（同時実行数を制限してイベントループを塞がない）
+async def _run_in_executor(func, *args):
+    global _semaphore
+    if _semaphore is None:
+        _semaphore = asyncio.Semaphore(max(1, PASSWORD_HASH_MAX_PENDING))
+    async with _semaphore:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(_get_executor(), func, *args)
+
+# パスワードのハッシュ化（非同期）
+async def hash_password_async(password: str):
+    return await _run_in_executor(hash_password, password)
+
+# パスワードの検証（非同期）
+async def verify_and_update_async(password: str, hashed_password: str):
+    return await _run_in_executor(verify_and_update, password, hashed_password)
+
+# プロセスプールを終了する関数（アプリ終了時に呼ぶ）
+def shutdown_executor():
+    global _executor, _semaphore
+    if _executor is not None:
+        _executor.shutdown(wait=False, cancel_futures=True)
+    _executor = None
+    _semaphore = None
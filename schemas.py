@@ -1,4 +1,6 @@
 from pydantic import BaseModel
+from datetime import datetime
+from typing import List, Optional
 
 class Token(BaseModel):
     access_token: str
@@ -9,5 +11,33 @@ class UserCreate(BaseModel):
     email: str
     password: str
 
+class Principal(BaseModel):
+    user_id: int
+    user_name: str
+    oura_id: Optional[int] = None
+
 class UserInDB(UserCreate):
-    hashed_password: str
\ No newline at end of file
+    hashed_password: str
+
+class CopingMessageItem(BaseModel):
+    coping_message_id: int
+    coping_message_text: Optional[str]
+
+class CopingMessageResponse(BaseModel):
+    user_name: str
+    assistant_text: Optional[str]
+    coping_messages: List[CopingMessageItem]
+
+class HeartRateBucket(BaseModel):
+    start: datetime
+    min: int
+    mean: float
+    max: int
+    count: int
+
+class HeartRateHistoryResponse(BaseModel):
+    user_name: str
+    start: datetime
+    end: datetime
+    resolution: int
+    buckets: List[HeartRateBucket]
@@ -0,0 +1,33 @@
+import os
+from dataclasses import dataclass
+from functools import lru_cache
+from typing import Optional
+from dotenv import load_dotenv
+
+# APIサーバーの設定値
+@dataclass(frozen=True)
+class Settings:
+    oura_api_key_1: Optional[str]
+    oura_api_key_2: Optional[str]
+    gpt_api_key: Optional[str]
+    # Oura Webhookの設定（user_idは通知のuser_idからoura_id(1/2)を判別するために使う）
+    oura_user_id_1: Optional[str] = None
+    oura_user_id_2: Optional[str] = None
+    oura_webhook_secret: Optional[str] = None
+    oura_webhook_verification_token: Optional[str] = None
+    oura_webhook_enabled: bool = False
+
+# 設定を読み込む関数（最初の呼び出し時に.envと環境変数から1度だけ作成する）
+@lru_cache(maxsize=1)
+def get_settings():
+    load_dotenv()
+    return Settings(
+        oura_api_key_1=os.getenv('OURA_API_KEY_1'),
+        oura_api_key_2=os.getenv('OURA_API_KEY_2'),
+        gpt_api_key=os.getenv('GPT_API_KEY'),
+        oura_user_id_1=os.getenv('OURA_USER_ID_1'),
+        oura_user_id_2=os.getenv('OURA_USER_ID_2'),
+        oura_webhook_secret=os.getenv('OURA_WEBHOOK_SECRET'),
+        oura_webhook_verification_token=os.getenv('OURA_WEBHOOK_VERIFICATION_TOKEN'),
+        oura_webhook_enabled=os.getenv('OURA_WEBHOOK_ENABLED', '').lower() in ('1', 'true', 'yes', 'on')
+    )
@@ -1 +1,6 @@
-python -m uvicorn main:app --host 0.0.0.0
\ No newline at end of file
+# スキーマ作成・マイグレーション（RUN_MIGRATIONS=1 の場合のみ実行）
+if [ "${RUN_MIGRATIONS:-0}" = "1" ]; then
+    python -m db.db_init
+fi
+
+python -m uvicorn main:app --host 0.0.0.0
@@ -0,0 +1,66 @@
+import time
+from collections import OrderedDict
+from threading import Lock
+
+# 有効期限(TTL)と最大件数(LRU)付きのインメモリキャッシュ
+class TTLCache:
+    def __init__(self, maxsize: int = 256, ttl: float = 600.0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._data = OrderedDict()
+        self._lock = Lock()
+
+    # キャッシュから値を取得する関数。期限切れ・未登録の場合はNoneを返す
+    def get(self, key):
+        now = time.monotonic()
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                self.misses += 1
+                return None
+            expires_at, value = item
+            if expires_at <= now:
+                del self._data[key]
+                self.misses += 1
+                return None
+            # 最近使ったものを末尾へ移動
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    # キャッシュに値を登録する関数。上限を超えた場合は最も古いものから削除
+    def set(self, key, value, ttl: float = None):
+        expires_at = time.monotonic() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            self._data[key] = (expires_at, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    # 指定したキーを削除する関数
+    def invalidate(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    # すべてのキーを削除する関数
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    # ヒット数などの統計情報を返す関数
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "size": len(self._data),
+                "maxsize": self.maxsize,
+                "ttl": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": self.hits / total if total else 0.0
+            }
@@ -0,0 +1,123 @@
+import asyncio
+import hashlib
+import os
+import random
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
+
+# 負荷試験用のOuraAPI・OpenAI APIのスタブサーバー
+# 起動例: STUB_LATENCY_MS=200 python -m uvicorn upstream_stub:app --port 8100
+
+# 応答までの遅延（ミリ秒）とそのゆらぎ、心拍数サンプルの最大件数
+STUB_LATENCY_MS = float(os.getenv('STUB_LATENCY_MS', '100'))
+STUB_LATENCY_JITTER_MS = float(os.getenv('STUB_LATENCY_JITTER_MS', '20'))
+STUB_HEARTRATE_SAMPLES = int(os.getenv('STUB_HEARTRATE_SAMPLES', '120'))
+
+# OpenAI APIの応答遅延（ミリ秒）と、429を返す割合
+STUB_OPENAI_LATENCY_MS = float(os.getenv('STUB_OPENAI_LATENCY_MS', '1500'))
+STUB_OPENAI_ERROR_RATE = float(os.getenv('STUB_OPENAI_ERROR_RATE', '0'))
+
+app = FastAPI()
+
+# エンドポイントごとの呼び出し回数
+call_counts = Counter()
+
+# 設定した遅延を再現する関数
+async def simulate_latency(latency_ms: float = None):
+    base = STUB_LATENCY_MS if latency_ms is None else latency_ms
+    delay = max(0.0, base + random.uniform(-STUB_LATENCY_JITTER_MS, STUB_LATENCY_JITTER_MS))
+    await asyncio.sleep(delay / 1000)
+
+# APIキーと日付から毎回同じスコアを作る関数
+def stable_score(api_key: str, day: str, low: int = 40, high: int = 100):
+    digest = hashlib.sha256(f"{api_key}:{day}".encode()).digest()
+    return low + digest[0] % (high - low + 1)
+
+# APIキーと日付から1日分のdaily_readinessを作る関数
+def readiness_entry(api_key: str, day_str: str, document_id: str = None):
+    return {
+        "id": document_id or hashlib.md5(f"{api_key}:{day_str}".encode()).hexdigest(),
+        "day": day_str,
+        "score": stable_score(api_key, day_str),
+        "temperature_deviation": 0.1,
+        "contributors": {
+            name: stable_score(api_key, f"{day_str}:{name}")
+            for name in [
+                "activity_balance", "body_temperature", "hrv_balance", "previous_day_activity",
+                "previous_night", "recovery_index", "resting_heart_rate", "sleep_balance"
+            ]
+        },
+        "timestamp": f"{day_str}T00:00:00+00:00"
+    }
+
+# daily_readinessのスタブ
+@app.get('/v2/usercollection/daily_readiness')
+async def daily_readiness(request: Request, start_date: str, end_date: str):
+    call_counts['daily_readiness'] += 1
+    await simulate_latency()
+    api_key = request.headers.get('Authorization', '')
+    start = datetime.strptime(start_date, '%Y-%m-%d').date()
+    end = datetime.strptime(end_date, '%Y-%m-%d').date()
+
+    data = []
+    day = start
+    while day <= end:
+        data.append(readiness_entry(api_key, day.isoformat()))
+        day += timedelta(days=1)
+    return {"data": data, "next_token": None}
+
+# daily_readiness（1件）のスタブ。Webhookで通知されたドキュメントとして、常に当日のデータを返す
+@app.get('/v2/usercollection/daily_readiness/{document_id}')
+async def daily_readiness_document(request: Request, document_id: str):
+    call_counts['daily_readiness_document'] += 1
+    await simulate_latency()
+    api_key = request.headers.get('Authorization', '')
+    return readiness_entry(api_key, datetime.now().date().isoformat(), document_id)
+
+# heartrateのスタブ（指定期間内のサンプルを最大STUB_HEARTRATE_SAMPLES件返す）
+@app.get('/v2/usercollection/heartrate')
+async def heartrate(start_datetime: str = None, end_datetime: str = None):
+    call_counts['heartrate'] += 1
+    await simulate_latency()
+    end = datetime.fromisoformat(end_datetime) if end_datetime else datetime.now(timezone.utc)
+    start = datetime.fromisoformat(start_datetime) if start_datetime else end - timedelta(days=1)
+
+    # 5秒間隔のサンプルを期間の終わりから遡って作る
+    count = min(STUB_HEARTRATE_SAMPLES, max(0, int((end - start).total_seconds() // 5)))
+    data = [
+        {
+            "bpm": 60 + random.randint(0, 30),
+            "source": "awake",
+            "timestamp": (end - timedelta(seconds=5 * i)).astimezone(timezone.utc).isoformat(timespec='seconds')
+        }
+        for i in reversed(range(count))
+    ]
+    return {"data": data, "next_token": None}
+
+# OpenAI chat completionsのスタブ
+@app.post('/v1/chat/completions')
+async def chat_completions(request: Request):
+    body = await request.json()
+    if random.random() < STUB_OPENAI_ERROR_RATE:
+        call_counts['chat_completions_429'] += 1
+        return JSONResponse(status_code=429, content={"error": {"message": "Rate limit reached", "type": "requests"}})
+
+    call_counts['chat_completions'] += 1
+    await simulate_latency(STUB_OPENAI_LATENCY_MS)
+    topic = body["messages"][-1]["content"]
+    content = f"{topic}で少し肩の力を抜いてみましょう。短い時間でも心と体がほぐれます。"
+    return {
+        "id": f"chatcmpl-stub-{random.getrandbits(32):08x}",
+        "object": "chat.completion",
+        "created": int(datetime.now(timezone.utc).timestamp()),
+        "model": body.get("model", "stub"),
+        "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+        "usage": {"prompt_tokens": 100, "completion_tokens": 50, "total_tokens": 150}
+    }
+
+# 呼び出し回数の取得
+@app.get('/_stats')
+async def stats():
+    return dict(call_counts)
@@ -0,0 +1,75 @@
+import argparse
+import hashlib
+import hmac
+import json
+import os
+import time
+import uuid
+from datetime import datetime, timezone
+import httpx
+from dotenv import load_dotenv
+
+# Oura Webhookの送信元の代わりに、署名付きの通知をローカルのAPIに送るスクリプト
+# APIはOURA_API_BASE_URLをupstream_stubに向け、OURA_WEBHOOK_SECRET・OURA_USER_ID_1を同じ値で起動しておく
+# 実行例: python webhook_test.py --url http://127.0.0.1:8000/oura/webhook --count 10
+
+# Ouraと同じ方式（タイムスタンプ+本文のHMAC-SHA256）で署名を計算する関数
+# （APIのモジュールを読み込むとDBに接続するため、ここでは独立して実装する）
+def compute_signature(secret: str, timestamp: str, body: bytes):
+    return hmac.new(secret.encode(), timestamp.encode() + body, hashlib.sha256).hexdigest().upper()
+
+# 署名付きの通知を1件送る関数
+def send_notification(client: httpx.Client, url: str, secret: str, event: dict, tamper: bool = False):
+    body = json.dumps(event).encode()
+    timestamp = str(int(time.time()))
+    signature = compute_signature(secret, timestamp, body)
+    if tamper:
+        # 署名の検証で拒否されることを確認するため、署名後に本文を書き換える
+        body = body.replace(b'"update"', b'"delete"').replace(b'"create"', b'"delete"')
+    headers = {
+        'Content-Type': 'application/json',
+        'x-oura-timestamp': timestamp,
+        'x-oura-signature': signature
+    }
+    return client.post(url, content=body, headers=headers)
+
+def main(argv=None):
+    load_dotenv()
+    parser = argparse.ArgumentParser(description="Oura Webhookの通知をローカルのAPIに送る")
+    parser.add_argument("--url", default="http://127.0.0.1:8000/oura/webhook", help="Webhookの受信URL")
+    parser.add_argument("--secret", default=os.getenv('OURA_WEBHOOK_SECRET'), help="署名に使うシークレット")
+    parser.add_argument("--verification-token", default=os.getenv('OURA_WEBHOOK_VERIFICATION_TOKEN'), help="指定した場合は登録時の検証も確認する")
+    parser.add_argument("--user-id", default=os.getenv('OURA_USER_ID_1'), help="通知に含めるOuraのuser_id")
+    parser.add_argument("--data-type", default="daily_readiness", help="通知するデータ種別")
+    parser.add_argument("--event-type", default="update", choices=["create", "update", "delete"], help="通知するイベント種別")
+    parser.add_argument("--object-id", help="通知するドキュメントのID（省略時は通知ごとに生成）")
+    parser.add_argument("--count", type=int, default=1, help="送る通知の数")
+    parser.add_argument("--tamper", action="store_true", help="署名後に本文を書き換えて送る（401になることを確認する）")
+    args = parser.parse_args(argv)
+
+    if not args.secret:
+        parser.error("--secret or OURA_WEBHOOK_SECRET is required")
+
+    with httpx.Client(timeout=10) as client:
+        if args.verification_token:
+            challenge = uuid.uuid4().hex
+            response = client.get(args.url, params={"verification_token": args.verification_token, "challenge": challenge})
+            ok = response.status_code == 200 and response.json().get("challenge") == challenge
+            print(f"verification: {response.status_code} {'ok' if ok else 'NG'}")
+
+        statuses = {}
+        for _ in range(args.count):
+            event = {
+                "event_type": args.event_type,
+                "data_type": args.data_type,
+                "object_id": args.object_id or uuid.uuid4().hex,
+                "event_time": datetime.now(timezone.utc).isoformat(timespec='seconds'),
+                "user_id": args.user_id
+            }
+            response = send_notification(client, args.url, args.secret, event, args.tamper)
+            result = response.json().get("status") if response.status_code == 202 else response.status_code
+            statuses[result] = statuses.get(result, 0) + 1
+        print(f"sent {args.count} notifications: {statuses}")
+
+if __name__ == "__main__":
+    main()